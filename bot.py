@@ -3,237 +3,2943 @@
 🚀 МОНИТОРИНГ ДЛЯ НОВОЙ ИГРЫ (два канала: стоки + новости)
 """
 
+import time
+_MODULE_STARTED = time.perf_counter()
+
 import os
-import disnake as discord
-import requests
-from flask import Flask
+import asyncio
+import importlib
 import threading
-import time
-from datetime import datetime
+from datetime import datetime, timezone
 import sys
 import logging
 import html
+import re
+import json
+import gzip
+import zlib
+import math
+import sqlite3
+from queue import Queue, Empty
+import itertools
+import functools
+import heapq
+import concurrent.futures
+from collections import deque, OrderedDict
+
+IMPORT_SECONDS = {}
+
+
+def _timed_import(name):
+    """Импорт тяжёлой зависимости с замером времени — для профиля запуска в /health"""
+    started = time.perf_counter()
+    module = importlib.import_module(name)
+    IMPORT_SECONDS[name] = time.perf_counter() - started
+    return module
+
+
+# Flask и waitress импортируются лениво в потоке веб-сервера, уже после подключения к шлюзу
+aiohttp = _timed_import('aiohttp')
+discord = _timed_import('disnake')
+
+# ==================== НАСТРОЙКА ЛОГГИНГА ====================
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# ==================== ПРОВЕРКА ВЕРСИИ ====================
+print(f"🚀 Python: {sys.version}")
+
+# ==================== ПРОФИЛЬ ЗАПУСКА ====================
+class StartupProfile:
+    """Время импортов и фаз холодного старта от начала загрузки модуля"""
+
+    def __init__(self, started, imports):
+        self.started = started
+        self.imports = imports
+        self.phases = {}
+
+    def mark(self, phase):
+        """Отмечает фазу один раз — повторные подключения не сдвигают цифры"""
+        if phase in self.phases:
+            return
+        self.phases[phase] = time.perf_counter() - self.started
+        logger.info(f"⏱️ Запуск: {phase} — {self.phases[phase] * 1000:.0f} мс")
+
+    def report(self):
+        return {
+            'imports_ms': {name: round(seconds * 1000, 1) for name, seconds in list(self.imports.items())},
+            'phases_ms': {phase: round(seconds * 1000, 1) for phase, seconds in list(self.phases.items())},
+        }
+
+
+startup = StartupProfile(_MODULE_STARTED, IMPORT_SECONDS)
+
+# ==================== НАСТРОЙКИ ====================
+DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
+TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
+TELEGRAM_BOT_CHAT_ID = os.getenv('TELEGRAM_BOT_CHAT_ID')
+RENDER_SERVICE_URL = os.getenv('RENDER_SERVICE_URL', 'https://stock-bot-cj4s.onrender.com')
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org')
+DISCORD_API_URL = os.getenv('DISCORD_API_URL', 'https://discord.com/api/v10')
+
+# Резервный опрос REST API, пока шлюз Discord недоступен
+FALLBACK_POLL_INTERVAL = float(os.getenv('FALLBACK_POLL_INTERVAL', '5'))   # сек между опросами во время разрыва
+FALLBACK_MAX_AGE = float(os.getenv('FALLBACK_MAX_AGE', '600'))             # сообщения старше — без алертов
+FALLBACK_PAGE_SIZE = 100                                                   # максимум Discord для /messages
+
+# Очередь отправки в Telegram
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))      # сообщений в секунду на чат
+TELEGRAM_CHAT_BURST = int(os.getenv('TELEGRAM_CHAT_BURST', '3'))      # допустимая пачка подряд
+TELEGRAM_MAX_RETRIES = int(os.getenv('TELEGRAM_MAX_RETRIES', '5'))
+TELEGRAM_BACKOFF_BASE = 1.0
+TELEGRAM_BACKOFF_MAX = 60.0
+TELEGRAM_QUEUE_FILE = os.getenv('TELEGRAM_QUEUE_FILE', 'telegram_queue.json')
+
+# Рассылка алертов: 'stickers' — стикер на каждый предмет, 'digest' — одно общее сообщение
+ALERT_MODE = os.getenv('ALERT_MODE', 'stickers')
+RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', '100'))        # отформатированных стоков в памяти
+
+# Изменения стока: алерты только по позициям, которые поменялись с прошлого стока
+STOCK_DIFF = os.getenv('STOCK_DIFF', '1') == '1'
+STOCK_FULL_EVERY = int(os.getenv('STOCK_FULL_EVERY', '12'))           # каждый N-й сток — полностью (0 — только первый)
+
+# История стоков (SQLite); пусто — не записывать
+HISTORY_DB = os.getenv('HISTORY_DB', 'stock_history.db')
+
+# Фоновые задачи на event loop и сторож шлюза
+KEEPALIVE_INTERVAL = float(os.getenv('KEEPALIVE_INTERVAL', '480'))          # внешний пинг, чтобы Render не усыплял
+STATUS_DIGEST_INTERVAL = float(os.getenv('STATUS_DIGEST_INTERVAL', '4800'))  # сводка в бота
+SNAPSHOT_INTERVAL = float(os.getenv('SNAPSHOT_INTERVAL', '15'))             # снапшот очереди и кеша дублей
+WATCHDOG_INTERVAL = 15.0
+WATCHDOG_STALL = float(os.getenv('WATCHDOG_STALL', '120'))                  # сек без heartbeat ACK — перезапуск
+
+# Прогноз рестока и прогрев доставки перед ним
+RESTOCK_WINDOW = int(os.getenv('RESTOCK_WINDOW', '48'))              # стоков в окне прогноза
+PREWARM_LEAD = float(os.getenv('PREWARM_LEAD', '20'))                # за сколько секунд до стока прогревать
+PREWARM_CHECK_INTERVAL = 5.0                                         # как часто сверяться с прогнозом
+GATEWAY_LATENCY_LIMIT = 10.0                                         # heartbeat дольше — шлюз считаем подвисшим
+
+# Каталог предметов (перечитывается на лету)
+ITEMS_FILE = os.getenv('ITEMS_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'items.json'))
+ITEMS_RELOAD_INTERVAL = float(os.getenv('ITEMS_RELOAD_INTERVAL', '5'))
+
+# Защита от дублей
+DEDUP_CACHE_SIZE = int(os.getenv('DEDUP_CACHE_SIZE', '50'))           # ID на каждый канал
+DEDUP_CACHE_FILE = os.getenv('DEDUP_CACHE_FILE', 'processed_messages.json')  # пусто — без снапшота
+EDIT_TRACK_SIZE = int(os.getenv('EDIT_TRACK_SIZE', '200'))            # стоков, правки которых сравниваются
+
+# Таблица маршрутов (несколько игр и серверов); без файла маршруты собираются из переменных ниже
+ROUTES_FILE = os.getenv('ROUTES_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'routes.json'))
+
+# НОВЫЕ ПЕРЕМЕННЫЕ:
+STOCKS_CHANNEL_ID = os.getenv('STOCKS_CHANNEL_ID')           # ID канала со стоками
+STOCKS_TELEGRAM_CHANNEL = os.getenv('STOCKS_TELEGRAM_CHANNEL')  # Куда отправлять стикеры
+STOCKS_AUTHOR_IDS = os.getenv('STOCKS_AUTHOR_IDS', '')             # ID Kiro через запятую — надёжнее имени
+STOCKS_WEBHOOK_IDS = os.getenv('STOCKS_WEBHOOK_IDS', '')           # ID вебхуков, которые публикуют стоки
+STOCKS_APPLICATION_IDS = os.getenv('STOCKS_APPLICATION_IDS', '')   # ID приложений (ботов) со стоками
+NEWS_CHANNEL_ID = os.getenv('NEWS_CHANNEL_ID')               # ID новостного канала
+NEWS_TELEGRAM_CHANNEL = os.getenv('NEWS_TELEGRAM_CHANNEL')   # Куда отправлять новости
+
+# Проверка обязательных переменных
+REQUIRED_VARS = ['DISCORD_TOKEN', 'TELEGRAM_TOKEN']
+ENV_ROUTE_VARS = ['STOCKS_CHANNEL_ID', 'STOCKS_TELEGRAM_CHANNEL']   # нужны, только если нет ROUTES_FILE
+
+def check_config():
+    """Проверяет переменные окружения и таблицу маршрутов; вызывается при запуске, а не при импорте"""
+    required = REQUIRED_VARS if os.path.exists(ROUTES_FILE) else REQUIRED_VARS + ENV_ROUTE_VARS
+    missing = [var for var in required if not os.getenv(var)]
+    if missing:
+        logger.error(f'❌ Отсутствуют переменные: {missing}')
+        exit(1)
+    
+    try:
+        routes.load()
+    except (OSError, ValueError) as e:
+        logger.error(f"❌ Ошибка таблицы маршрутов {ROUTES_FILE}: {e}")
+        exit(1)
+    
+    for route in routes:
+        logger.info(f"🧭 {route.label()}")
+    logger.info(f"🤖 Бот Telegram: {TELEGRAM_BOT_CHAT_ID}")
+
+# ==================== МЕТРИКИ ====================
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+GATEWAY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60)
+HOT_PATH_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    """Счётчик в формате Prometheus (с метками)"""
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in values]
+
+    def snapshot(self):
+        """Текущие значения {кортеж меток: значение}"""
+        with self._lock:
+            return dict(self._values)
+
+
+class Gauge:
+    """Значение, которое читается функцией в момент выгрузки метрик"""
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, getter):
+        self.name = name
+        self.help_text = help_text
+        self.getter = getter
+
+    def render(self):
+        return [f"{self.name} {self.getter()}"]
+
+
+class Histogram:
+    """Гистограмма длительностей в формате Prometheus"""
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        return _HistogramTimer(self, labels)
+
+    def render(self):
+        with self._lock:
+            series_list = [(key, list(counts), total, count) for key, (counts, total, count) in self._series.items()]
+        lines = []
+        for key, counts, total, count in series_list:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels + ('le',), key + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels + ('le',), key + ('+Inf',))} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class _HistogramTimer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+GATEWAY_LATENCY = metrics.register(Histogram(
+    'stockbot_gateway_latency_seconds', 'Время от создания сообщения в Discord до вызова обработчика',
+    ('channel',), GATEWAY_BUCKETS))
+HANDLER_SECONDS = metrics.register(Histogram(
+    'stockbot_handler_seconds', 'Время обработки сообщения со стоком', ('channel',), HOT_PATH_BUCKETS))
+PARSE_SECONDS = metrics.register(Histogram(
+    'stockbot_parse_seconds', 'Время разбора эмбедов в StockRecord', (), HOT_PATH_BUCKETS))
+EXTRACT_SECONDS = metrics.register(Histogram(
+    'stockbot_extract_seconds', 'Время extract_full_content', (), HOT_PATH_BUCKETS))
+MATCH_SECONDS = metrics.register(Histogram(
+    'stockbot_match_seconds', 'Время поиска предметов', (), HOT_PATH_BUCKETS))
+TELEGRAM_SECONDS = metrics.register(Histogram(
+    'stockbot_telegram_request_seconds', 'Длительность запроса к Telegram Bot API', ('method', 'chat', 'status')))
+TELEGRAM_DELIVERY_SECONDS = metrics.register(Histogram(
+    'stockbot_telegram_delivery_seconds', 'Время от постановки в очередь до доставки в Telegram', ('method', 'chat')))
+TELEGRAM_REQUESTS = metrics.register(Counter(
+    'stockbot_telegram_requests_total', 'Запросы к Telegram Bot API', ('method', 'chat', 'status')))
+TELEGRAM_RATE_LIMITED = metrics.register(Counter(
+    'stockbot_telegram_rate_limited_total', 'Ответы 429 от Telegram', ('chat',)))
+TELEGRAM_RETRIES = metrics.register(Counter(
+    'stockbot_telegram_retries_total', 'Повторные отправки в Telegram после ошибок', ('chat',)))
+DEDUP_HITS = metrics.register(Counter(
+    'stockbot_dedup_hits_total', 'Сообщения, отброшенные защитой от дублей', ('channel',)))
+STOCKS_PROCESSED = metrics.register(Counter(
+    'stockbot_stocks_total', 'Обработанные стоки', ('channel', 'result')))
+MESSAGES_REJECTED = metrics.register(Counter(
+    'stockbot_messages_rejected_total', 'Сообщения, отсеянные префильтром до разбора', ('reason',)))
+FALLBACK_REQUESTS = metrics.register(Counter(
+    'stockbot_fallback_requests_total', 'Запросы резервного опроса к REST API Discord', ('status',)))
+FALLBACK_MESSAGES = metrics.register(Counter(
+    'stockbot_fallback_messages_total', 'Сообщения, полученные резервным опросом', ('channel', 'result')))
+STOCK_EDITS = metrics.register(Counter(
+    'stockbot_stock_edits_total', 'Правки сообщений со стоками', ('channel', 'result')))
+MESSAGES_ACCEPTED = metrics.register(Counter(
+    'stockbot_messages_accepted_total', 'Сообщения, прошедшие префильтр', ('route',)))
+
+# ==================== ЗАЩИТА ОТ ДУБЛЕЙ ====================
+class DedupCache:
+    """Кеш обработанных сообщений: отдельная очередь на канал, вытесняются самые старые ID"""
+
+    def __init__(self, max_size=DEDUP_CACHE_SIZE, state_file=DEDUP_CACHE_FILE):
+        self.max_size = max_size
+        self.state_file = state_file
+        self.channels = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def add(self, channel_id, message_id):
+        """Запоминает сообщение, возвращает False если оно уже было обработано"""
+        channel_id = str(channel_id)
+        with self._lock:
+            seen = self.channels.get(channel_id)
+            if seen is None:
+                seen = self.channels[channel_id] = OrderedDict()
+            if message_id in seen:
+                return False
+            seen[message_id] = None
+            if len(seen) > self.max_size:
+                seen.popitem(last=False)
+            # На диск кеш сбрасывает периодический снапшот, а не обработчик сообщения
+            self._dirty = True
+        return True
+
+    def __contains__(self, key):
+        channel_id, message_id = key
+        with self._lock:
+            return message_id in self.channels.get(str(channel_id), ())
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(seen) for seen in self.channels.values())
+
+    def last_id(self, channel_id):
+        """Самый новый обработанный ID канала — курсор для догоняющего опроса"""
+        with self._lock:
+            seen = self.channels.get(str(channel_id))
+            return max(seen) if seen else None
+
+    def save(self):
+        """Атомарно сохраняет кеш на диск, чтобы рестарт не повторил последние стоки"""
+        if not self.state_file:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {channel_id: list(seen) for channel_id, seen in self.channels.items()}
+            self._dirty = False
+        tmp_path = f"{self.state_file}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.state_file)
+        except OSError as e:
+            self._dirty = True
+            logger.error(f"❌ Не удалось сохранить кеш дублей: {e}")
+
+    def load(self):
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"❌ Не удалось прочитать кеш дублей: {e}")
+            return
+        with self._lock:
+            for channel_id, ids in data.items():
+                self.channels[channel_id] = OrderedDict.fromkeys(ids[-self.max_size:])
+        logger.info(f"📥 Восстановлен кеш дублей: {len(self)} сообщений")
+
+# ==================== ОБЩЕЕ СОСТОЯНИЕ ====================
+class StateSnapshot:
+    """Согласованный срез счётчиков на один момент времени; читателям не нужна блокировка"""
+
+    __slots__ = ('version', 'found', 'ping_count', 'last_ping_time', 'processed')
+
+    def __init__(self, version, found, ping_count, last_ping_time, processed):
+        self.version = version
+        self.found = found
+        self.ping_count = ping_count
+        self.last_ping_time = last_ping_time
+        self.processed = processed
+
+    def found_stats(self, items):
+        """Строки «эмодзи имя: счётчик» для найденных предметов каталога"""
+        return [f"{items[item_name]['emoji']} {items[item_name]['display_name']}: {count}"
+                for item_name, count in self.found.items() if count > 0 and item_name in items]
+
+
+class BotState:
+    """Счётчики бота: пишут цикл Discord и самопинг, читают потоки waitress"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._found = {}
+        self._ping_count = 0
+        self._last_ping_time = None
+        self._processed = 0
+        self._version = 0
+        self._snapshot = None
+
+    def _changed(self):
+        self._version += 1
+        self._snapshot = None
+
+    def track_items(self, item_names):
+        """Заводит нулевые счётчики для новых предметов, старые значения сохраняются"""
+        with self._lock:
+            for item_name in item_names:
+                if item_name not in self._found:
+                    self._found[item_name] = 0
+                    self._changed()
+
+    def add_found(self, item_names):
+        with self._lock:
+            for item_name in item_names:
+                self._found[item_name] = self._found.get(item_name, 0) + 1
+            if item_names:
+                self._changed()
+
+    def message_processed(self):
+        with self._lock:
+            self._processed += 1
+            self._changed()
+
+    def record_ping(self):
+        """Отмечает самопинг, возвращает его номер"""
+        with self._lock:
+            self._ping_count += 1
+            self._last_ping_time = datetime.now()
+            self._changed()
+            return self._ping_count
+
+    @property
+    def version(self):
+        return self._version
+
+    def snapshot(self):
+        """Копия счётчиков под блокировкой; между изменениями отдаётся один и тот же срез"""
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return snapshot
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = StateSnapshot(self._version, dict(self._found), self._ping_count,
+                                               self._last_ping_time, self._processed)
+            return self._snapshot
+
+
+# ==================== ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ====================
+bot_start_time = datetime.now()
+state = BotState()
+processed_messages = DedupCache()
+
+# ==================== КОНФИГУРАЦИЯ ПРЕДМЕТОВ ====================
+# Необязательные ключи: 'match' — 'word' или 'exact' (по умолчанию 'word'),
+# 'exclude' — слова, после которых ключевое слово не считается (["blossom"] для "cherry blossom"),
+# 'min_quantity' — алерт только если в стоке не меньше N штук
+TARGET_ITEMS = {
+    'cherry': {
+        'keywords': ['cherry', 'cherry seed', '🍒'],
+        'sticker_id': "CAACAgIAAxkBAAEQnoFpnyHlfKoDssWIpZHbKrjgBUkgAQACy5AAAv894EjYncv41k4_XzoE",
+        'emoji': '🍒',
+        'display_name': 'Cherry',
+        'exclude': ['blossom']
+    },
+    'cabbage': {
+        'keywords': ['cabbage', 'cabbage seed', '🥬'],
+        'sticker_id': "CAACAgIAAxkBAAEQnoNpnyHvhLutfLJmqqqqk8_TWy-8wAACZ5YAAho06UipuXAdrrQYXToE",
+        'emoji': '🥬',
+        'display_name': 'Cabbage'
+    },
+    'super_sprinkler': {
+        'keywords': ['super sprinkler'],
+        'sticker_id': "CAACAgIAAxkBAAEQnoVpnyH24p9XG865neBZzotLJBqyTwACzp0AAtmT-UgP-Ruhrq3S3joE",
+        'emoji': '💧',
+        'display_name': 'Super Sprinkler',
+        'exclude': ['box']
+    }
+}
+
+# Встроенный каталог на случай, если файла ITEMS_FILE нет
+state.track_items(TARGET_ITEMS)
+
+# ==================== TELEGRAM ФУНКЦИИ ====================
+class TelegramClient:
+    """Асинхронный клиент Telegram Bot API с общим пулом соединений на event loop бота"""
+
+    def __init__(self, token, api_url=TELEGRAM_API_URL, timeout=10, pool_size=20):
+        self.token = token
+        self.api_url = api_url.rstrip('/')
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._session = None
+
+    def _new_session(self):
+        connector = aiohttp.TCPConnector(limit=self.pool_size, ttl_dns_cache=300, keepalive_timeout=60)
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout)
+        )
+
+    async def get_session(self):
+        """Общая сессия aiohttp; создаётся лениво внутри цикла и переиспользуется всеми запросами"""
+        if self._session is None or self._session.closed:
+            self._session = self._new_session()
+        return self._session
+
+    async def call(self, method, payload, session=None):
+        """Вызывает метод Bot API, возвращает (HTTP статус, JSON ответ)"""
+        if session is None:
+            session = await self.get_session()
+        url = f"{self.api_url}/bot{self.token}/{method}"
+        async with session.post(url, json=payload) as response:
+            try:
+                data = await response.json(content_type=None)
+            except ValueError:
+                data = {'description': (await response.text())[:100]}
+            return response.status, data
+
+    async def warm(self):
+        """Открывает соединение с Bot API заранее (getMe), чтобы стикер не ждал TLS"""
+        try:
+            status, _ = await self.call('getMe', {})
+        except Exception as e:
+            logger.warning(f"⚠️ Прогрев Telegram не удался: {e!r}")
+            return False
+        return status == 200
+
+    async def deliver(self, method, payload, session=None):
+        """Отправляет запрос и логирует результат, возвращает True при успехе"""
+        chat_id = payload.get('chat_id')
+        try:
+            status, data = await self.call(method, payload, session)
+        except Exception as e:
+            logger.error(f'❌ Telegram error ({method}): {e!r}')
+            return False
+
+        if status == 200:
+            if method == 'sendSticker':
+                logger.info(f"📢 Стикер отправлен в канал {chat_id}")
+            else:
+                logger.info(f"✅ Telegram отправлено в {chat_id}")
+            return True
+        if status == 429:
+            retry_after = (data.get('parameters') or {}).get('retry_after', 30)
+            logger.warning(f"⚠️ Лимит Telegram для {chat_id}, retry_after={retry_after} сек")
+            return False
+        logger.error(f"❌ Telegram ошибка {status} ({method}): {str(data.get('description', ''))[:100]}")
+        return False
+
+    async def deliver_once(self, method, payload):
+        async with self._new_session() as session:
+            return await self.deliver(method, payload, session)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+class OutboundJob:
+    """Одна отправка в Telegram, ожидающая своей очереди"""
+    __slots__ = ('chat_id', 'method', 'payload', 'attempts', 'created_at', 'future')
+
+    def __init__(self, chat_id, method, payload, attempts=0):
+        self.chat_id = chat_id
+        self.method = method
+        self.payload = payload
+        self.attempts = attempts
+        self.created_at = time.monotonic()
+        self.future = None
+
+    def to_dict(self):
+        return {'chat_id': self.chat_id, 'method': self.method,
+                'payload': self.payload, 'attempts': self.attempts}
+
+
+class ChatBudget:
+    """Token bucket лимита отправок для одного чата + блокировка по retry_after"""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now):
+        """Сколько секунд ждать до следующей отправки (0 — можно сейчас)"""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class TelegramOutbox:
+    """Очередь исходящих сообщений: у каждого чата свой порядок, лимит и повторы"""
+
+    def __init__(self, client, rate=TELEGRAM_CHAT_RATE, burst=TELEGRAM_CHAT_BURST,
+                 max_retries=TELEGRAM_MAX_RETRIES, state_file=TELEGRAM_QUEUE_FILE):
+        self.client = client
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.state_file = state_file
+        self.loop = None
+        self.queues = {}
+        self.budgets = {}
+        self.workers = {}
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self._latencies = deque(maxlen=200)
+        self._latency_lock = threading.Lock()
+
+    def bind(self, loop):
+        self.loop = loop
+
+    def _loop_running(self):
+        loop = self.loop
+        return loop is not None and not loop.is_closed() and loop.is_running()
+
+    def put(self, chat_id, method, payload):
+        """Ставит отправку в очередь чата; безопасно вызывать из любого потока"""
+        return self.put_many(chat_id, [(method, payload)])[0]
+
+    def put_many(self, chat_id, requests):
+        """Ставит несколько отправок подряд, без вклинивания чужих сообщений.
+
+        Отправки чата уходят строго по одной: параллельный старт сломал бы порядок в чате,
+        если первый запрос получит 429, а следующий уже успеет дойти.
+        Возвращает список future — по одному на отправку.
+        """
+        jobs = [OutboundJob(str(chat_id), method, payload) for method, payload in requests]
+        if not self._loop_running():
+            # Цикл бота ещё не запущен или уже остановлен — отправляем синхронно
+            # во временном цикле (мы точно не в потоке Discord)
+            return [asyncio.run(self.client.deliver_once(job.method, job.payload)) for job in jobs]
+
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if running is self.loop:
+            self._enqueue(jobs)
+            return [job.future for job in jobs]
+
+        waiters = [concurrent.futures.Future() for _ in jobs]
+        self.loop.call_soon_threadsafe(self._enqueue, jobs, waiters)
+        return waiters
+
+    def _enqueue(self, jobs, waiters=None):
+        for index, job in enumerate(jobs):
+            if job.future is None:
+                job.future = self.loop.create_future()
+            if waiters is not None:
+                job.future.add_done_callback(lambda future, waiter=waiters[index]: self._relay(waiter, future))
+        self.queues.setdefault(jobs[0].chat_id, deque()).extend(jobs)
+        self._ensure_worker(jobs[0].chat_id)
+
+    @staticmethod
+    def _relay(waiter, future):
+        """Передаёт результат отправки ожидающему из другого потока"""
+        if future.cancelled():
+            waiter.cancel()  # остановка бота: ждать больше нечего
+        else:
+            waiter.set_result(future.result())
+
+    def _ensure_worker(self, chat_id):
+        if chat_id not in self.workers:
+            self.workers[chat_id] = self.loop.create_task(self._worker(chat_id))
+
+    def start(self):
+        """Запускает обработчики для сообщений, восстановленных из файла"""
+        for chat_id, queue in self.queues.items():
+            for job in queue:
+                if job.future is None:
+                    job.future = self.loop.create_future()
+            if queue:
+                self._ensure_worker(chat_id)
+
+    @staticmethod
+    def _resolve(job, ok):
+        if job.future is not None and not job.future.done():
+            job.future.set_result(ok)
+
+    def _record_latency(self, seconds):
+        with self._latency_lock:
+            self._latencies.append(seconds)
+
+    async def _send(self, job):
+        started = time.perf_counter()
+        try:
+            status, data = await self.client.call(job.method, job.payload)
+        except Exception as e:
+            status, data = None, {'description': repr(e)}
+        status_label = str(status) if status is not None else 'error'
+        TELEGRAM_SECONDS.observe(time.perf_counter() - started,
+                                 method=job.method, chat=job.chat_id, status=status_label)
+        TELEGRAM_REQUESTS.inc(method=job.method, chat=job.chat_id, status=status_label)
+        return status, data
+
+    async def _worker(self, chat_id):
+        queue = self.queues[chat_id]
+        budget = self.budgets.get(chat_id)
+        if budget is None:
+            budget = self.budgets[chat_id] = ChatBudget(self.rate, self.burst)
+
+        try:
+            while queue:
+                wait = budget.delay(time.monotonic())
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+
+                job = queue[0]
+                budget.consume()
+                status, data = await self._send(job)
+                self._handle_result(queue, budget, job, status, data)
+        finally:
+            self.workers.pop(chat_id, None)
+
+    def _handle_result(self, queue, budget, job, status, data):
+        chat_id = job.chat_id
+        if status == 200:
+            queue.remove(job)
+            self.sent += 1
+            delivery_time = time.monotonic() - job.created_at
+            self._record_latency(delivery_time)
+            TELEGRAM_DELIVERY_SECONDS.observe(delivery_time, method=job.method, chat=chat_id)
+            if job.method == 'sendSticker':
+                logger.info(f"📢 Стикер отправлен в канал {chat_id}")
+            else:
+                logger.info(f"✅ Telegram отправлено в {chat_id}")
+            self._resolve(job, True)
+
+        elif status == 429:
+            # Ждём только этот чат, остальные продолжают отправку
+            retry_after = (data.get('parameters') or {}).get('retry_after', 30)
+            self.rate_limited += 1
+            TELEGRAM_RATE_LIMITED.inc(chat=chat_id)
+            budget.block(retry_after)
+            logger.warning(f"⚠️ Лимит Telegram для {chat_id}, повтор через {retry_after} сек "
+                           f"(в очереди: {len(queue)})")
+
+        elif status is None or status >= 500:
+            job.attempts += 1
+            description = str(data.get('description', ''))[:100]
+            if job.attempts > self.max_retries:
+                queue.remove(job)
+                self.failed += 1
+                logger.error(f"❌ Telegram {job.method} в {chat_id}: отказ после "
+                             f"{self.max_retries} повторов ({description})")
+                self._resolve(job, False)
+            else:
+                backoff = min(TELEGRAM_BACKOFF_MAX, TELEGRAM_BACKOFF_BASE * 2 ** (job.attempts - 1))
+                self.retries += 1
+                TELEGRAM_RETRIES.inc(chat=chat_id)
+                budget.block(backoff)
+                logger.warning(f"🔄 Telegram {job.method} в {chat_id}: ошибка {status or description}, "
+                               f"повтор #{job.attempts} через {backoff:.1f} сек")
+
+        else:
+            # 4xx кроме 429 — повтор не поможет
+            queue.remove(job)
+            self.failed += 1
+            logger.error(f"❌ Telegram ошибка {status} ({job.method}): "
+                         f"{str(data.get('description', ''))[:100]}")
+            self._resolve(job, False)
+
+    def depth(self):
+        return sum(len(queue) for queue in list(self.queues.values()))
+
+    def stats(self):
+        with self._latency_lock:
+            latencies = sorted(self._latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 1)
+
+        return {
+            'depth': self.depth(),
+            'chats': {chat_id: len(queue) for chat_id, queue in list(self.queues.items()) if queue},
+            'sent': self.sent,
+            'failed': self.failed,
+            'retries': self.retries,
+            'rate_limited': self.rate_limited,
+            'latency_ms': {'p50': percentile(0.5), 'p99': percentile(0.99),
+                           'last': round(latencies[-1] * 1000, 1) if latencies else None},
+        }
+
+    def pending(self):
+        """Копия неотправленных сообщений; вызывать на цикле бота, который меняет очереди"""
+        return [job.to_dict() for queue in self.queues.values() for job in queue]
+
+    def save(self, jobs=None):
+        """Сохраняет неотправленные сообщения, чтобы не потерять их при рестарте.
+
+        jobs — готовая копия pending(): с ней запись на диск можно вынести в пул потоков.
+        """
+        if not self.state_file:
+            return
+        if jobs is None:
+            jobs = self.pending()
+        try:
+            if not jobs:
+                if os.path.exists(self.state_file):
+                    os.remove(self.state_file)
+                return
+            tmp_path = f"{self.state_file}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(jobs, f, ensure_ascii=False)
+            os.replace(tmp_path, self.state_file)
+            logger.info(f"💾 Очередь Telegram сохранена ({len(jobs)} сообщений)")
+        except OSError as e:
+            logger.error(f"❌ Не удалось сохранить очередь Telegram: {e}")
+
+    def load(self):
+        """Восстанавливает очередь, сохранённую при прошлой остановке"""
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, encoding='utf-8') as f:
+                jobs = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"❌ Не удалось прочитать очередь Telegram: {e}")
+            return
+        for data in jobs:
+            job = OutboundJob(data['chat_id'], data['method'], data['payload'], data.get('attempts', 0))
+            self.queues.setdefault(job.chat_id, deque()).append(job)
+        logger.info(f"📥 Восстановлено сообщений в очереди Telegram: {len(jobs)}")
+
+
+telegram = TelegramClient(TELEGRAM_TOKEN)
+outbox = TelegramOutbox(telegram)
+metrics.register(Gauge('stockbot_telegram_queue_depth', 'Сообщений в очереди Telegram', outbox.depth))
+
+def send_telegram(chat_id, text, parse_mode="HTML"):
+    """Отправляет сообщение в Telegram через очередь, не блокируя event loop"""
+    return outbox.put(chat_id, 'sendMessage', {"chat_id": chat_id, "text": text, "parse_mode": parse_mode})
+
+def send_to_bot(text):
+    """Отправляет сообщение в личку бота"""
+    if TELEGRAM_BOT_CHAT_ID:
+        return send_telegram(TELEGRAM_BOT_CHAT_ID, text)
+    return False
+
+_sticker_requests = {}
+
+def sticker_request(chat_id, sticker_id):
+    """Готовый запрос sendSticker; собирается один раз на чат и стикер"""
+    key = (chat_id, sticker_id)
+    request = _sticker_requests.get(key)
+    if request is None:
+        request = _sticker_requests[key] = ('sendSticker', {"chat_id": chat_id, "sticker": sticker_id})
+    return request
+
+def format_found_item(item_config, record=None):
+    """Строка вида "🍒 Cherry x3" для уведомлений"""
+    quantity = f" x{record.quantity}" if record is not None and record.quantity is not None else ""
+    return f"{item_config['emoji']} {item_config['display_name']}{quantity}"
+
+def send_item_alerts(chat_id, items, matches, mode=ALERT_MODE):
+    """Ставит алерты по всем найденным в стоке предметам в очередь чата одним блоком.
+
+    matches — {предмет: (ItemMatch, StockRecord | None)} в порядке каталога.
+    """
+    if mode == 'digest':
+        lines = "\n".join(format_found_item(items[name], record) for name, (_, record) in matches.items())
+        return [send_telegram(chat_id, f"🎯 <b>В стоке:</b>\n{lines}")]
+
+    requests = [sticker_request(chat_id, items[name]['sticker_id'])
+                for name in matches if items[name].get('sticker_id')]
+    if not requests:
+        return []
+    return outbox.put_many(chat_id, requests)
+
+# ==================== ИЗВЛЕЧЕНИЕ ТЕКСТА ====================
+def extract_full_content(message):
+    """Извлекает весь текст из сообщения Discord"""
+    full_content = ""
+    
+    # 1. Текст сообщения
+    if message.content:
+        full_content += f"{message.content}\n\n"
+    
+    # 2. Эмбеды
+    if message.embeds:
+        for embed in message.embeds:
+            if embed.title:
+                full_content += f"{embed.title}\n"
+            if embed.description:
+                full_content += f"{embed.description}\n"
+            if embed.fields:
+                for field in embed.fields:
+                    full_content += f"\n{field.name}\n{field.value}\n"
+            if embed.footer and embed.footer.text:
+                full_content += f"\n{embed.footer.text}\n"
+    
+    # 3. Очистка
+    full_content = re.sub(r'<:[^:]+:\d+>', '', full_content)
+    full_content = re.sub(r'\*\*', '', full_content)
+    full_content = html.escape(full_content)
+    full_content = '\n'.join([line.strip() for line in full_content.split('\n') if line.strip()])
+    
+    return full_content.strip()
+
+# ==================== ФОРМАТИРОВАНИЕ СТОКА ====================
+TELEGRAM_MESSAGE_LIMIT = 4096
+STOCK_HEADER_RESERVE = 1024   # место под заголовок и подпись в каждом куске
+_ENTITY_TAIL_RE = re.compile(r'&[#\w]{0,8}$')
+
+
+class RenderedStock:
+    """Текст стока для вывода и его разбивка на куски под лимит Telegram"""
+    __slots__ = ('fingerprint', 'text', 'pieces')
+
+    def __init__(self, fingerprint, text, pieces):
+        self.fingerprint = fingerprint
+        self.text = text
+        self.pieces = pieces
+
+
+def _safe_cut(line, size):
+    """Позиция разреза длинной строки, не попадающая внутрь HTML-сущности (&amp;)"""
+    entity = _ENTITY_TAIL_RE.search(line[:size])
+    if entity and entity.start() > 0:
+        return entity.start()
+    return size
+
+
+def split_lines(text, size):
+    """Режет текст на куски не длиннее size, по возможности по границам строк"""
+    pieces = []
+    current = []
+    current_len = 0
+    for line in text.split('\n'):
+        while len(line) > size:
+            if current:
+                pieces.append('\n'.join(current))
+                current, current_len = [], 0
+            cut = _safe_cut(line, size)
+            pieces.append(line[:cut])
+            line = line[cut:]
+        extra = len(line) + (1 if current else 0)
+        if current and current_len + extra > size:
+            pieces.append('\n'.join(current))
+            current, current_len = [], 0
+            extra = len(line)
+        current.append(line)
+        current_len += extra
+    if current:
+        pieces.append('\n'.join(current))
+    return pieces
+
+
+def _message_fingerprint(message):
+    return hash((
+        message.content,
+        tuple(
+            (embed.title, embed.description,
+             tuple((field.name, field.value) for field in embed.fields),
+             embed.footer.text if embed.footer else None)
+            for embed in message.embeds or ()
+        ),
+    ))
+
+
+_render_cache = OrderedDict()
+
+
+def render_stock(message):
+    """Текст стока и его куски; кешируется по ID сообщения, пока содержимое не изменилось"""
+    fingerprint = _message_fingerprint(message)
+    cached = _render_cache.get(message.id)
+    if cached is not None and cached.fingerprint == fingerprint:
+        _render_cache.move_to_end(message.id)
+        return cached
+
+    with EXTRACT_SECONDS.time():
+        text = extract_full_content(message)
+    body_limit = TELEGRAM_MESSAGE_LIMIT - STOCK_HEADER_RESERVE - len('<pre></pre>')
+    rendered = RenderedStock(fingerprint, text, split_lines(text, body_limit) if text else [])
+
+    _render_cache[message.id] = rendered
+    if len(_render_cache) > RENDER_CACHE_SIZE:
+        _render_cache.popitem(last=False)
+    return rendered
+
+
+def build_stock_messages(header, rendered, footer=''):
+    """Сообщения с полным стоком: заголовок в первом, подпись в последнем"""
+    total = len(rendered.pieces)
+    messages = []
+    # Заголовок, не влезающий в резерв (очень много предметов), уходит отдельным сообщением
+    if len(header) + len(footer) > STOCK_HEADER_RESERVE:
+        messages.extend(split_lines(header.rstrip('\n'), TELEGRAM_MESSAGE_LIMIT))
+        header = ''
+    for index, piece in enumerate(rendered.pieces, 1):
+        head = header if index == 1 else f"📋 <b>Полный сток ({index}/{total}):</b>\n"
+        tail = footer if index == total else ''
+        messages.append(f"{head}<pre>{piece}</pre>{tail}")
+    return messages
+
+
+def send_stock_to_bot(header, rendered, footer='', chat_id=None):
+    """Отправляет полный сток в бота (или в лог-чат маршрута) по кускам, в исходном порядке"""
+    chat_id = chat_id or TELEGRAM_BOT_CHAT_ID
+    if not chat_id:
+        return []
+    messages = build_stock_messages(header, rendered, footer)
+    return outbox.put_many(chat_id, [
+        ('sendMessage', {"chat_id": chat_id, "text": text, "parse_mode": "HTML"})
+        for text in messages
+    ])
+
+# ==================== РАЗБОР СТОКА ====================
+_CUSTOM_EMOJI_RE = re.compile(r'<a?:[^:>]+:\d+>')
+_MARKDOWN_RE = re.compile(r'\*\*|__|`|~~')
+_DISCORD_TIME_RE = re.compile(r'<t:(\d+)(?::[a-zA-Z])?>')
+_RELATIVE_TIME_RE = re.compile(r'(\d+)\s*(h|m|s)\w*', re.IGNORECASE)
+_RESTOCK_RE = re.compile(r'restock|рестокн?|обновлени', re.IGNORECASE)
+_PRICE_RE = re.compile(
+    r'(?:[$¢💰]\s*(\d[\d,.]*)\s*([kmb])?\b'
+    r'|\b(\d[\d,.]*)\s*([kmb])?\s*(?:[$¢💰]|coins?|sheckles?)(?!\w))',
+    re.IGNORECASE
+)
+_QUANTITY_RE = re.compile(
+    r'(?:\bx\s*(\d+)\b|\b(\d+)\s*x\b|\((\d+)\)|[:\-–—]\s*(\d+)\s*$)',
+    re.IGNORECASE
+)
+_SUFFIXES = {'k': 1_000, 'm': 1_000_000, 'b': 1_000_000_000}
+
+
+class StockRecord:
+    """Одна позиция стока: предмет, категория, количество, цена, время рестока"""
+    __slots__ = ('item', 'category', 'quantity', 'price', 'restock')
+
+    def __init__(self, item, category=None, quantity=None, price=None, restock=None):
+        self.item = item
+        self.category = category
+        self.quantity = quantity
+        self.price = price
+        self.restock = restock
+
+    def __repr__(self):
+        return (f"StockRecord({self.item!r}, category={self.category!r}, quantity={self.quantity}, "
+                f"price={self.price}, restock={self.restock})")
+
+
+def _clean_markup(text):
+    text = _CUSTOM_EMOJI_RE.sub('', text)
+    return _MARKDOWN_RE.sub('', text).strip()
+
+
+def _parse_number(digits, suffix=None):
+    try:
+        value = float(digits.replace(',', ''))
+    except ValueError:
+        return None
+    if suffix:
+        value *= _SUFFIXES[suffix.lower()]
+    return int(value)
+
+
+def _parse_restock(text):
+    """Время рестока из строки вида "Next restock: <t:...:R>" или "restock in 4m 30s" """
+    if not _RESTOCK_RE.search(text):
+        return None
+    stamp = _DISCORD_TIME_RE.search(text)
+    if stamp:
+        return datetime.fromtimestamp(int(stamp.group(1)))
+    units = {'h': 3600, 'm': 60, 's': 1}
+    seconds = sum(int(amount) * units[unit.lower()] for amount, unit in _RELATIVE_TIME_RE.findall(text))
+    if seconds:
+        return datetime.fromtimestamp(time.time() + seconds)
+    return None
+
+
+def parse_stock_line(line, category=None, restock=None):
+    """Разбирает строку поля эмбеда в StockRecord (None — если предмета в строке нет)"""
+    text = _clean_markup(line)
+    if not text:
+        return None
+
+    price = None
+    price_match = _PRICE_RE.search(text)
+    if price_match:
+        digits, suffix = (price_match.group(1), price_match.group(2)) if price_match.group(1) \
+            else (price_match.group(3), price_match.group(4))
+        price = _parse_number(digits, suffix)
+        text = (text[:price_match.start()] + text[price_match.end():]).strip()
+
+    quantity = None
+    quantity_match = _QUANTITY_RE.search(text)
+    if quantity_match:
+        quantity = int(next(group for group in quantity_match.groups() if group))
+        text = (text[:quantity_match.start()] + text[quantity_match.end():]).strip()
+
+    item = text.strip(' \t-–—:•*|,()[]')
+    if not item:
+        return None
+    return StockRecord(item, category, quantity, price, restock)
+
+
+def _stock_segments(message):
+    """Куски эмбедов, которые разбираются независимо: (ключ, текст, категория, строка рестока, это описание).
+
+    Ресток отдаётся исходной строкой: относительное "in 5m" даёт новое время при каждом разборе
+    и не годится для отпечатка куска.
+    """
+    for embed_index, embed in enumerate(message.embeds or ()):
+        restock = None
+        for text in (embed.title, embed.description, embed.footer.text if embed.footer else None):
+            if text and restock is None and _RESTOCK_RE.search(text):
+                restock = text
+
+        category = _clean_markup(embed.title) if embed.title else None
+
+        if embed.description:
+            yield ('description', embed_index), embed.description, category, restock, True
+
+        for field_index, field in enumerate(embed.fields):
+            if _RESTOCK_RE.search(field.name):
+                continue
+            yield (('field', embed_index, field_index), field.value or '',
+                   _clean_markup(field.name) or category, restock, False)
+
+
+def _parse_segment(text, category, restock, description):
+    records = []
+    for line in text.split('\n'):
+        # Позиции в описании бывают только со счётчиком ("Cherry x3"), остальное — заголовки
+        if description and (not _QUANTITY_RE.search(line) or _RESTOCK_RE.search(line)):
+            continue
+        record = parse_stock_line(line, category, restock)
+        if record:
+            records.append(record)
+    return records
+
+
+def parse_stock_segments(message, previous=None):
+    """Разбор по кускам эмбедов: куски, не изменившиеся с previous, не разбираются заново.
+
+    Возвращает ({ключ: (отпечаток, [StockRecord])}, сколько кусков разобрано заново).
+    """
+    segments = {}
+    reparsed = 0
+    restocks = {}
+    for key, text, category, restock_text, description in _stock_segments(message):
+        fingerprint = (text, category, restock_text)
+        cached = previous.get(key) if previous else None
+        if cached is not None and cached[0] == fingerprint:
+            segments[key] = cached
+            continue
+        if restock_text not in restocks:
+            restocks[restock_text] = _parse_restock(restock_text) if restock_text else None
+        segments[key] = (fingerprint, _parse_segment(text, category, restocks[restock_text], description))
+        reparsed += 1
+    return segments, reparsed
+
+
+def segment_records(segments):
+    return [record for _, records in segments.values() for record in records]
+
+
+# ==================== ПОИСК ПРЕДМЕТОВ ====================
+class ItemMatch:
+    """Найденное ключевое слово и его позиция в тексте"""
+    __slots__ = ('item', 'keyword', 'start', 'end')
+
+    def __init__(self, item, keyword, start, end):
+        self.item = item
+        self.keyword = keyword
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return f"ItemMatch({self.item!r}, {self.keyword!r}, {self.start}, {self.end})"
+
+
+class ItemMatcher:
+    """Все ключевые слова предметов в одном скомпилированном regex — один проход по тексту.
+
+    Режимы совпадения ('match' в конфиге предмета):
+      word  — ключевое слово целиком, не часть другого слова;
+      exact — точная фраза: вдобавок рядом на той же строке нет других слов
+              ("2x super sprinkler x2" подходит, "super sprinkler box" — нет).
+    'exclude' — слова, после которых ключевое слово не считается предметом
+    ("cherry" с exclude ["blossom"] не найдёт "Cherry Blossom", но найдёт "Cherry Seed is in stock").
+    """
+
+    MODES = ('word', 'exact')
+
+    def __init__(self, items):
+        entries = []
+        for item_name, config in items.items():
+            mode = config.get('match', 'word')
+            if mode not in self.MODES:
+                raise ValueError(f"Неизвестный режим совпадения {mode!r} у {item_name}")
+            exclude = tuple(word.lower() for word in config.get('exclude') or ())
+            for keyword in config['keywords']:
+                entries.append((keyword.lower(), item_name, mode, exclude))
+
+        # Длинные фразы раньше коротких: "cherry seed" выигрывает у "cherry"
+        entries.sort(key=lambda entry: len(entry[0]), reverse=True)
+        self._entries = entries
+        self._order = {item_name: index for index, item_name in enumerate(items)}
+        self._min_quantity = {item_name: config.get('min_quantity') for item_name, config in items.items()}
+        parts = [f"(?P<k{index}>{self._pattern(keyword, mode, exclude)})"
+                 for index, (keyword, _, mode, exclude) in enumerate(entries)]
+        self._regex = re.compile('|'.join(parts), re.IGNORECASE) if parts else None
+
+    @staticmethod
+    def _phrase(text):
+        return r'[ \t]+'.join(re.escape(word) for word in text.split())
+
+    @classmethod
+    def _pattern(cls, keyword, mode, exclude=()):
+        body = cls._phrase(keyword)
+        # Границы слова ставим только со стороны букв/цифр, эмодзи ищем как есть
+        lead = r'(?<!\w)' if keyword[0].isalnum() else ''
+        trail = r'(?!\w)' if keyword[-1].isalnum() else ''
+        if mode == 'exact':
+            # Слева можно только счётчик "2x", справа — только "x2"
+            lead = r'(?<![^\W\dx_][ \t])(?<![^\W\d]x[ \t])' + lead
+            trail += r'(?![ \t]+(?!x\d)[^\W\d_])'
+        if exclude:
+            trail += r'(?![ \t]+(?:' + '|'.join(cls._phrase(word) for word in exclude) + r')(?!\w))'
+        return lead + body + trail
+
+    def find(self, text):
+        """Все совпадения в тексте с позициями"""
+        if self._regex is None:
+            return []
+        matches = []
+        for m in self._regex.finditer(text):
+            keyword, item_name, _, _ = self._entries[int(m.lastgroup[1:])]
+            matches.append(ItemMatch(item_name, keyword, m.start(), m.end()))
+        return matches
+
+    def match(self, text):
+        """Первое совпадение для каждого найденного предмета, в порядке конфига"""
+        found = {}
+        for item_match in self.find(text):
+            found.setdefault(item_match.item, item_match)
+        return dict(sorted(found.items(), key=lambda pair: self._order[pair[0]]))
+
+    def match_records(self, records):
+        """Ищет предметы в разобранных позициях стока с учётом min_quantity.
+
+        Возвращает {предмет: (ItemMatch, StockRecord)} в порядке конфига.
+        """
+        found = {}
+        for record in records:
+            for item_match in self.find(record.item):
+                item_name = item_match.item
+                min_quantity = self._min_quantity[item_name]
+                if min_quantity and record.quantity is not None and record.quantity < min_quantity:
+                    continue
+                found.setdefault(item_name, (item_match, record))
+        return dict(sorted(found.items(), key=lambda pair: self._order[pair[0]]))
+
+# ==================== КАТАЛОГ ПРЕДМЕТОВ ====================
+class CatalogueSnapshot:
+    """Неизменяемая версия каталога: предметы и собранный по ним матчер"""
+    __slots__ = ('items', 'matcher', 'version')
+
+    def __init__(self, items, matcher, version):
+        self.items = items
+        self.matcher = matcher
+        self.version = version
+
+
+class ItemCatalogue:
+    """Каталог отслеживаемых предметов из файла с горячей перезагрузкой.
+
+    Читатели берут catalogue.current один раз на сообщение — подмена снапшота
+    одним присваиванием атомарна, поэтому предметы и матчер всегда согласованы.
+    """
+
+    def __init__(self, path=ITEMS_FILE, defaults=TARGET_ITEMS):
+        self.path = path
+        self.current = CatalogueSnapshot(defaults, ItemMatcher(defaults), 0)
+        self._mtime = None
+        self._listeners = []
+
+    def on_reload(self, callback):
+        """Регистрирует обработчик callback(old, new) после подмены каталога"""
+        self._listeners.append(callback)
+
+    def _read(self):
+        with open(self.path, encoding='utf-8') as f:
+            if self.path.endswith(('.yml', '.yaml')):
+                import yaml  # необязательная зависимость, нужна только для YAML-каталога
+                return yaml.safe_load(f)
+            return json.load(f)
+
+    @staticmethod
+    def _validate(items):
+        if not isinstance(items, dict) or not items:
+            raise ValueError("каталог должен быть непустым объектом {ключ: предмет}")
+        normalized = {}
+        for item_name, config in items.items():
+            keywords = config.get('keywords')
+            if not keywords or not all(isinstance(keyword, str) and keyword.strip() for keyword in keywords):
+                raise ValueError(f"у {item_name} нет ключевых слов")
+            exclude = config.get('exclude') or []
+            if not isinstance(exclude, list) or not all(isinstance(word, str) and word.strip() for word in exclude):
+                raise ValueError(f"у {item_name} 'exclude' должен быть списком слов")
+            normalized[item_name] = {
+                'keywords': list(keywords),
+                'sticker_id': config.get('sticker_id'),
+                'emoji': config.get('emoji', '🎯'),
+                'display_name': config.get('display_name', item_name),
+                'match': config.get('match', 'word'),
+                'exclude': list(config.get('exclude') or ()),
+                'min_quantity': config.get('min_quantity'),
+            }
+        return normalized
+
+    @staticmethod
+    def _matcher_spec(items):
+        return [(item_name, tuple(config['keywords']), config.get('match', 'word'),
+                 tuple(config.get('exclude') or ()), config.get('min_quantity'))
+                for item_name, config in items.items()]
+
+    def load(self):
+        """Читает файл и атомарно подменяет каталог; при ошибке остаётся старый"""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            if self._mtime is None:
+                logger.info(f"📄 Файл каталога {self.path} не найден, использую встроенный список")
+                self._mtime = 0
+            return False
+
+        self._mtime = mtime
+        try:
+            items = self._validate(self._read())
+            old = self.current
+            # Матчер пересобираем только если поменялись ключевые слова или режимы
+            if self._matcher_spec(items) == self._matcher_spec(old.items):
+                matcher = old.matcher
+            else:
+                matcher = ItemMatcher(items)
+        except Exception as e:
+            logger.error(f"❌ Ошибка в каталоге {self.path}: {e}")
+            return False
+
+        new = CatalogueSnapshot(items, matcher, old.version + 1)
+        self.current = new
+        logger.info(f"📦 Каталог v{new.version} загружен: {len(items)} предметов")
+        for callback in self._listeners:
+            try:
+                callback(old, new)
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработчика перезагрузки каталога: {e}")
+        return True
+
+    def maybe_reload(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return False
+        if mtime == self._mtime:
+            return False
+        return self.load()
+
+
+
+def _sync_counters(old, new):
+    """Заводит счётчики для новых предметов, старые значения сохраняются"""
+    state.track_items(new.items)
+    if old.version == 0:
+        return  # первая загрузка при старте — не уведомляем
+    added = [name for name in new.items if name not in old.items]
+    removed = [name for name in old.items if name not in new.items]
+    if added or removed:
+        send_to_bot(
+            f"🔄 <b>Каталог предметов обновлён (v{new.version})</b>\n"
+            + (f"➕ {', '.join(new.items[name]['display_name'] for name in added)}\n" if added else "")
+            + (f"➖ {', '.join(old.items[name]['display_name'] for name in removed)}\n" if removed else "")
+        )
+
+
+catalogue = ItemCatalogue()
+catalogue.on_reload(_sync_counters)
+
+# ==================== МАРШРУТЫ ====================
+ROUTE_KINDS = ('stock', 'news')
+
+
+class Route:
+    """Конвейер одного канала Discord: фильтр авторов, каталог предметов, чаты Telegram и формат алертов"""
+
+    __slots__ = ('name', 'kind', 'guild_id', 'channel_id', 'key', 'authors', 'author_ids', 'webhook_ids',
+                 'application_ids', 'catalogue', 'chat_id', 'log_chat_id', 'alert_mode', '_verdicts',
+                 'channel_ref', 'guild_ref')
+
+    def __init__(self, name, kind, guild_id, channel_id, authors, catalogue, chat_id, log_chat_id, alert_mode,
+                 author_ids=frozenset(), webhook_ids=frozenset(), application_ids=frozenset()):
+        self.name = name
+        self.kind = kind
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.key = str(channel_id)       # метка канала в метриках, кеше дублей и истории
+        self.authors = authors
+        self.author_ids = author_ids
+        self.webhook_ids = webhook_ids
+        self.application_ids = application_ids
+        self.catalogue = catalogue
+        self.chat_id = chat_id
+        self.log_chat_id = log_chat_id
+        self.alert_mode = alert_mode
+        self._verdicts = {}              # ID автора → причина отказа или None; имя проверяется один раз
+        self.channel_ref = RestRef(channel_id)   # для сообщений резервного опроса
+        self.guild_ref = RestRef(guild_id)
+
+    @property
+    def pinned(self):
+        """Авторы заданы по ID — имя не учитывается вовсе"""
+        return bool(self.author_ids or self.webhook_ids or self.application_ids)
+
+    def reject_reason(self, message):
+        """Префильтр: None — сообщение для маршрута, иначе причина отказа (для метрик)"""
+        if self.guild_id is not None and getattr(message.guild, 'id', None) != self.guild_id:
+            return 'guild'
+        if self.pinned:
+            if (message.author.id in self.author_ids
+                    or message.webhook_id in self.webhook_ids
+                    or getattr(message, 'application_id', None) in self.application_ids):
+                return None
+            return 'author'
+        if not self.authors:
+            return None
+        author = message.author
+        verdict = self._verdicts.get(author.id, False)
+        if verdict is False:
+            # Имя сверяем подстрокой, как раньше («Kiro Bot», «KiroStock»), но только у ботов:
+            # пользователь «kiro123» не пройдёт
+            name = author.name.lower()
+            if not author.bot:
+                verdict = 'not_bot'
+            elif not any(expected in name for expected in self.authors):
+                verdict = 'author'
+            else:
+                verdict = None
+                logger.info(f"📌 {self.name}: автор {author.name} id={author.id} — "
+                            f"закрепите его в author_ids, чтобы не зависеть от имени")
+            if len(self._verdicts) >= 1024:
+                self._verdicts.clear()
+            self._verdicts[author.id] = verdict
+        return verdict
+
+    def label(self):
+        icon = '📦' if self.kind == 'stock' else '📰'
+        return f"{icon} {self.name}: канал {self.channel_id} → {self.chat_id or 'без Telegram'}"
+
+    def describe(self):
+        return {
+            'name': self.name,
+            'kind': self.kind,
+            'guild': str(self.guild_id) if self.guild_id else None,
+            'channel': self.key,
+            'authors': list(self.authors),
+            'author_ids': sorted(str(i) for i in self.author_ids | self.webhook_ids | self.application_ids),
+            'items': len(self.catalogue.current.items) if self.catalogue else None,
+            'chat': self.chat_id,
+            'alert_mode': self.alert_mode if self.kind == 'stock' else None,
+        }
+
+
+def _env_routes():
+    """Маршруты из старых переменных STOCKS_*/NEWS_* — один сток-канал и необязательный новостной"""
+    specs = []
+    if STOCKS_CHANNEL_ID:
+        specs.append({'name': 'stocks', 'kind': 'stock', 'channel': STOCKS_CHANNEL_ID,
+                      'chat': STOCKS_TELEGRAM_CHANNEL, 'authors': ['kiro'],
+                      'author_ids': STOCKS_AUTHOR_IDS.split(','),
+                      'webhook_ids': STOCKS_WEBHOOK_IDS.split(','),
+                      'application_ids': STOCKS_APPLICATION_IDS.split(',')})
+    if NEWS_CHANNEL_ID:
+        specs.append({'name': 'news', 'kind': 'news', 'channel': NEWS_CHANNEL_ID, 'chat': NEWS_TELEGRAM_CHANNEL})
+    return specs
+
+
+def _parse_id(value, field):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{field}: ожидается числовой ID, получено {value!r}")
+
+
+def _parse_ids(values, field):
+    return frozenset(_parse_id(value, field) for value in values or () if str(value).strip())
+
+
+class RouteTable:
+    """Таблица маршрутов: ID канала → Route, диспетчеризация одним поиском в словаре"""
+
+    def __init__(self, path=ROUTES_FILE):
+        self.path = path
+        self.by_channel = {}
+        self.catalogues = {ITEMS_FILE: catalogue}
+
+    def __iter__(self):
+        return iter(list(self.by_channel.values()))
+
+    def __len__(self):
+        return len(self.by_channel)
+
+    def get(self, channel_id):
+        return self.by_channel.get(channel_id)
+
+    def stock_routes(self):
+        return [route for route in self if route.kind == 'stock']
+
+    def guild_ids(self):
+        """Серверы из таблицы; пустое множество — маршруты без привязки к серверу"""
+        return {route.guild_id for route in self if route.guild_id is not None}
+
+    def catalogue_for(self, path):
+        """Каталог предметов маршрута; один файл — один общий каталог"""
+        if not path:
+            path = ITEMS_FILE
+        elif not os.path.isabs(path):
+            path = os.path.join(os.path.dirname(os.path.abspath(self.path)), path)
+        found = self.catalogues.get(path)
+        if found is None:
+            found = self.catalogues[path] = ItemCatalogue(path, defaults={})
+            found.on_reload(_sync_counters)
+        return found
+
+    def _read(self):
+        if not self.path or not os.path.exists(self.path):
+            return _env_routes()
+        with open(self.path, encoding='utf-8') as f:
+            data = json.load(f)
+        return data.get('routes', []) if isinstance(data, dict) else data
+
+    def _build(self, spec, index):
+        name = spec.get('name') or f"route{index}"
+        kind = spec.get('kind', 'stock')
+        if kind not in ROUTE_KINDS:
+            raise ValueError(f"{name}: kind должен быть одним из {ROUTE_KINDS}")
+        channel_id = _parse_id(spec.get('channel'), f"{name}.channel")
+        guild_id = _parse_id(spec['guild'], f"{name}.guild") if spec.get('guild') else None
+        chat_id = spec.get('chat')
+        if kind == 'stock' and not chat_id:
+            raise ValueError(f"{name}: для стоков нужен chat")
+        alert_mode = spec.get('alert_mode', ALERT_MODE)
+        if alert_mode not in ('stickers', 'digest'):
+            raise ValueError(f"{name}: alert_mode должен быть stickers или digest")
+        authors = tuple(author.lower() for author in spec.get('authors', ()))
+        return Route(
+            name=name,
+            kind=kind,
+            guild_id=guild_id,
+            channel_id=channel_id,
+            authors=authors,
+            catalogue=self.catalogue_for(spec.get('items')) if kind == 'stock' else None,
+            chat_id=str(chat_id) if chat_id else None,
+            log_chat_id=str(spec.get('log_chat', TELEGRAM_BOT_CHAT_ID) or '') or None,
+            alert_mode=alert_mode,
+            author_ids=_parse_ids(spec.get('author_ids'), f"{name}.author_ids"),
+            webhook_ids=_parse_ids(spec.get('webhook_ids'), f"{name}.webhook_ids"),
+            application_ids=_parse_ids(spec.get('application_ids'), f"{name}.application_ids"),
+        )
+
+    def load(self):
+        """Читает таблицу и подменяет её целиком; ошибка конфига — ValueError"""
+        table = {}
+        for index, spec in enumerate(self._read(), 1):
+            route = self._build(spec, index)
+            if route.channel_id in table:
+                raise ValueError(f"канал {route.channel_id} указан в двух маршрутах")
+            table[route.channel_id] = route
+        for route_catalogue in {id(r.catalogue): r.catalogue for r in table.values() if r.catalogue}.values():
+            if route_catalogue.current.version == 0:
+                route_catalogue.load()
+        self.by_channel = table
+        logger.info(f"🧭 Маршрутов: {len(table)}")
+        return table
+
+    def all_items(self):
+        """Предметы всех каталогов маршрутов — для дашборда"""
+        items = {}
+        for route in self.stock_routes():
+            items.update(route.catalogue.current.items)
+        return items
+
+
+routes = RouteTable()
+
+# ==================== ИЗМЕНЕНИЯ СТОКА ====================
+class StockDiff:
+    """Разница между двумя стоками канала"""
+    __slots__ = ('full', 'added', 'removed', 'changed')
+
+    def __init__(self, full, added, removed, changed):
+        self.full = full          # сток нужно разослать целиком (первый или по расписанию)
+        self.added = added        # {ключ: (название, количество)}
+        self.removed = removed    # {ключ: (название, количество)}
+        self.changed = changed    # {ключ: (название, было, стало)}
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def fresh(self, key):
+        """Позиция появилась или у неё поменялось количество"""
+        return key in self.added or key in self.changed
+
+
+def snapshot_key(item_name, record):
+    """Ключ позиции в снапшоте: название из стока, а без разбора — ключ предмета каталога"""
+    return record.item.lower() if record is not None else item_name
+
+
+def build_stock_snapshot(records, matches, items):
+    """Компактный снапшот стока {ключ: (название, количество)}"""
+    if records:
+        return {record.item.lower(): (record.item, record.quantity) for record in records}
+    return {item_name: (items[item_name]['display_name'], None) for item_name in matches}
+
+
+class StockDiffer:
+    """Хранит последний сток каждого канала и считает изменения за один проход"""
+
+    def __init__(self, enabled=STOCK_DIFF, full_every=STOCK_FULL_EVERY):
+        self.enabled = enabled
+        self.full_every = full_every
+        self.snapshots = {}
+        self.counts = {}
+        self.latest = {}
+
+    def update(self, channel_id, snapshot, message_id=None):
+        previous = self.snapshots.get(channel_id)
+        count = self.counts.get(channel_id, 0)
+        self.snapshots[channel_id] = snapshot
+        self.counts[channel_id] = count + 1
+        self.latest[channel_id] = message_id
+
+        full = (not self.enabled or previous is None
+                or (self.full_every > 0 and count % self.full_every == 0))
+        if previous is None:
+            return StockDiff(full, dict(snapshot), {}, {})
+
+        added = {}
+        changed = {}
+        for key, (name, quantity) in snapshot.items():
+            old = previous.get(key)
+            if old is None:
+                added[key] = (name, quantity)
+            elif old[1] != quantity:
+                changed[key] = (name, old[1], quantity)
+        removed = {key: value for key, value in previous.items() if key not in snapshot}
+        return StockDiff(full, added, removed, changed)
+
+    def replace(self, channel_id, message_id, snapshot):
+        """Правка последнего стока канала: следующий сток сравнивается уже с исправленным"""
+        if message_id is None or self.latest.get(channel_id) != message_id:
+            return False
+        self.snapshots[channel_id] = snapshot
+        return True
+
+
+def format_stock_diff(diff, limit=15):
+    """Строки с изменениями стока для сообщения в бота"""
+    def quantity(value):
+        return f" x{value}" if value is not None else ""
+
+    def section(title, entries):
+        entries = list(entries)
+        if not entries:
+            return []
+        shown = entries[:limit]
+        more = f"\n… и ещё {len(entries) - limit}" if len(entries) > limit else ""
+        return [f"{title}\n" + "\n".join(shown) + more]
+
+    parts = []
+    parts += section("➕ <b>Появились:</b>",
+                     (f"• {html.escape(name)}{quantity(qty)}" for name, qty in diff.added.values()))
+    parts += section("🔄 <b>Изменилось количество:</b>",
+                     (f"• {html.escape(name)}: {old if old is not None else '?'} → {new if new is not None else '?'}"
+                      for name, old, new in diff.changed.values()))
+    parts += section("➖ <b>Пропали:</b>",
+                     (f"• {html.escape(name)}" for name, _ in diff.removed.values()))
+    return "\n\n".join(parts)
+
+
+stock_differ = StockDiffer()
+
+# ==================== ИСТОРИЯ СТОКОВ ====================
+class HistoryStore:
+    """История стоков в SQLite (WAL). Запись — пачками в фоновом потоке, не из event loop"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS stocks (
+            id INTEGER PRIMARY KEY,
+            channel_id TEXT NOT NULL,
+            message_id INTEGER NOT NULL,
+            ts REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS stock_items (
+            stock_id INTEGER NOT NULL,
+            ts REAL NOT NULL,
+            item TEXT NOT NULL,
+            target TEXT,
+            category TEXT,
+            quantity INTEGER,
+            price INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS idx_stocks_channel_ts ON stocks(channel_id, ts);
+        CREATE INDEX IF NOT EXISTS idx_items_item_ts ON stock_items(item, ts);
+        CREATE INDEX IF NOT EXISTS idx_items_target_ts ON stock_items(target, ts);
+        CREATE INDEX IF NOT EXISTS idx_items_ts ON stock_items(ts);
+        CREATE INDEX IF NOT EXISTS idx_items_stock ON stock_items(stock_id);
+        -- Дневные итоги по предметам для /stats: не сканировать все позиции за месяцы
+        CREATE TABLE IF NOT EXISTS item_days (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            day INTEGER NOT NULL,
+            appearances INTEGER NOT NULL,
+            first_seen REAL NOT NULL,
+            last_seen REAL NOT NULL,
+            max_quantity INTEGER,
+            PRIMARY KEY (kind, key, day)
+        ) WITHOUT ROWID;
+    """
+
+    ROLLUP_UPSERT = """
+        INSERT INTO item_days (kind, key, day, appearances, first_seen, last_seen, max_quantity)
+        VALUES (?, ?, ?, 1, ?, ?, ?)
+        ON CONFLICT (kind, key, day) DO UPDATE SET
+            appearances = appearances + 1,
+            first_seen = MIN(first_seen, excluded.first_seen),
+            last_seen = MAX(last_seen, excluded.last_seen),
+            max_quantity = MAX(COALESCE(max_quantity, excluded.max_quantity),
+                               COALESCE(excluded.max_quantity, max_quantity))
+    """
+
+    # kind: 'item' — название из стока, 'target' — предмет каталога
+    ROLLUP_BACKFILL = """
+        INSERT INTO item_days (kind, key, day, appearances, first_seen, last_seen, max_quantity)
+        SELECT ?, {key}, CAST(ts / 86400 AS INTEGER) AS day,
+               COUNT(DISTINCT stock_id), MIN(ts), MAX(ts), MAX(quantity)
+        FROM stock_items WHERE {key} IS NOT NULL GROUP BY {key}, day
+    """
+
+    def __init__(self, path=HISTORY_DB, batch_size=200, flush_interval=2.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self._queue = Queue()
+        self._thread = None
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _reader(self):
+        # У каждого потока waitress своё соединение: WAL позволяет читать параллельно с записью
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    @property
+    def enabled(self):
+        return self._thread is not None
+
+    def start(self):
+        if not self.path or self._thread is not None:
+            return
+        conn = self._connect()
+        conn.executescript(self.SCHEMA)
+        self._backfill_rollup(conn)
+        conn.close()
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+        logger.info(f"🗄️ История стоков: {self.path}")
+
+    def _backfill_rollup(self, conn):
+        """Один раз считает дневные итоги по истории, записанной до их появления"""
+        if conn.execute('SELECT 1 FROM item_days LIMIT 1').fetchone() \
+                or not conn.execute('SELECT 1 FROM stock_items LIMIT 1').fetchone():
+            return
+        with conn:
+            conn.execute(self.ROLLUP_BACKFILL.format(key='item'), ('item',))
+            conn.execute(self.ROLLUP_BACKFILL.format(key='target'), ('target',))
+        logger.info("🗄️ Дневные итоги истории пересчитаны")
+
+    @staticmethod
+    def _rollup_rows(item_rows):
+        """Строки item_days одного стока: каждый предмет и каждая цель считаются один раз"""
+        if not item_rows:
+            return []
+        ts = item_rows[0][0]
+        quantities = {}
+        for _, item, target, _, quantity, _ in item_rows:
+            for key in (('item', item), ('target', target)):
+                if key[1] is not None:
+                    known = quantities.get(key)
+                    quantities[key] = quantity if known is None else max(known, quantity or known)
+        day = int(ts // 86400)
+        return [(kind, key, day, ts, ts, quantity) for (kind, key), quantity in quantities.items()]
+
+    def record(self, channel_id, message_id, records, matches, ts=None):
+        """Ставит сток в очередь на запись; не блокирует обработчик"""
+        if self._thread is None:
+            return
+        self._queue.put((str(channel_id), message_id, ts or time.time(), records, matches))
+
+    def _rows(self, entry):
+        channel_id, message_id, ts, records, matches = entry
+        targets = {}
+        for item_name, (_, record) in matches.items():
+            if record is not None:
+                targets[id(record)] = item_name
+        if records:
+            items = [(record.item.lower(), targets.get(id(record)), record.category, record.quantity, record.price)
+                     for record in records]
+        else:
+            items = [(item_name, item_name, None, None, None) for item_name in matches]
+        return (channel_id, message_id, ts), [(ts,) + item for item in items]
+
+    def _writer(self):
+        conn = self._connect()
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                break
+            batch = [entry]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    entry = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except Empty:
+                    break
+                if entry is None:
+                    stop = True
+                    break
+                batch.append(entry)
+            try:
+                with conn:
+                    for entry in batch:
+                        stock_row, item_rows = self._rows(entry)
+                        stock_id = conn.execute(
+                            'INSERT INTO stocks (channel_id, message_id, ts) VALUES (?, ?, ?)', stock_row).lastrowid
+                        conn.executemany(
+                            'INSERT INTO stock_items (stock_id, ts, item, target, category, quantity, price) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            [(stock_id,) + row for row in item_rows])
+                        conn.executemany(self.ROLLUP_UPSERT, self._rollup_rows(item_rows))
+                self.written += len(batch)
+            except sqlite3.Error as e:
+                logger.error(f"❌ Ошибка записи истории стоков: {e}")
+            if stop:
+                break
+        conn.close()
+
+    def close(self, timeout=5):
+        """Дописывает очередь и останавливает поток записи"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def history(self, item=None, since=None, limit=50):
+        """Последние появления предмета (или все позиции), новые сначала"""
+        query = ('SELECT s.channel_id, s.message_id, i.ts, i.item, i.target, i.category, i.quantity, i.price '
+                 'FROM stock_items i JOIN stocks s ON s.id = i.stock_id')
+        since_sql = ' AND ts >= ?' if since else ''
+        since_params = [since] if since else []
+        if item:
+            # OR по двум колонкам не идёт по индексу с сортировкой — берём limit новейших
+            # из (target, ts) и из (item, ts) отдельно и сливаем
+            query += (f' WHERE i.rowid IN ('
+                      f'SELECT rowid FROM (SELECT rowid FROM stock_items WHERE target = ?{since_sql} '
+                      f'ORDER BY ts DESC LIMIT ?) UNION '
+                      f'SELECT rowid FROM (SELECT rowid FROM stock_items WHERE item = ?{since_sql} '
+                      f'ORDER BY ts DESC LIMIT ?))')
+            params = [item, *since_params, limit, item.lower(), *since_params, limit]
+        elif since:
+            query += ' WHERE i.ts >= ?'
+            params = [since]
+        else:
+            params = []
+        query += ' ORDER BY i.ts DESC LIMIT ?'
+        params.append(limit)
+        return [dict(row) for row in self._reader().execute(query, params)]
+
+    def stats(self, item=None, since=None, targets_only=True, limit=100):
+        """Частота, первое/последнее появление и средний интервал между появлениями"""
+        conn = self._reader()
+        if item:
+            key_sql, where, params = 'COALESCE(target, item)', '(target = ? OR item = ?)', [item, item.lower()]
+            if since:
+                where += ' AND ts >= ?'
+                params.append(since)
+            rows = conn.execute(
+                f'SELECT {key_sql} AS item, COUNT(DISTINCT stock_id) AS appearances, '
+                f'MIN(ts) AS first_seen, MAX(ts) AS last_seen, MAX(quantity) AS max_quantity '
+                f'FROM stock_items WHERE {where} GROUP BY {key_sql} ORDER BY appearances DESC LIMIT ?',
+                params + [limit]).fetchall()
+            result = [dict(row) for row in rows]
+        else:
+            result = self._rollup_stats(conn, 'target' if targets_only else 'item', since, limit)
+
+        for entry in result:
+            count = entry['appearances']
+            entry['mean_interval'] = ((entry['last_seen'] - entry['first_seen']) / (count - 1)) if count > 1 else None
+
+        if item and result:
+            # Для одного предмета — ещё и медиана интервалов (по индексу item/target + ts)
+            times = [row[0] for row in conn.execute(
+                f'SELECT DISTINCT ts FROM stock_items WHERE {where} ORDER BY ts', params)]
+            gaps = sorted(b - a for a, b in zip(times, times[1:]))
+            result[0]['median_interval'] = gaps[len(gaps) // 2] if gaps else None
+        return result
+
+    @staticmethod
+    def _rollup_stats(conn, kind, since, limit):
+        """Итоги по всем предметам: целые дни из item_days, неполный первый день — из позиций по индексу ts"""
+        parts = []
+        first_day = math.ceil(since / 86400) if since else None
+        if since and since < first_day * 86400:
+            column = 'target' if kind == 'target' else 'item'
+            parts.append(conn.execute(
+                f'SELECT {column}, COUNT(DISTINCT stock_id), MIN(ts), MAX(ts), MAX(quantity) FROM stock_items '
+                f'WHERE ts >= ? AND ts < ? AND {column} IS NOT NULL GROUP BY {column}',
+                (since, first_day * 86400)))
+        parts.append(conn.execute(
+            'SELECT key, SUM(appearances), MIN(first_seen), MAX(last_seen), MAX(max_quantity) FROM item_days '
+            'WHERE kind = ? AND day >= ? GROUP BY key', (kind, first_day if first_day is not None else -1)))
+
+        totals = {}
+        for rows in parts:
+            for key, appearances, first_seen, last_seen, max_quantity in rows:
+                entry = totals.get(key)
+                if entry is None:
+                    totals[key] = {'item': key, 'appearances': appearances, 'first_seen': first_seen,
+                                   'last_seen': last_seen, 'max_quantity': max_quantity}
+                    continue
+                entry['appearances'] += appearances
+                entry['first_seen'] = min(entry['first_seen'], first_seen)
+                entry['last_seen'] = max(entry['last_seen'], last_seen)
+                if max_quantity is not None:
+                    entry['max_quantity'] = max(entry['max_quantity'] or max_quantity, max_quantity)
+        return sorted(totals.values(), key=lambda entry: entry['appearances'], reverse=True)[:limit]
+
+    def recent_stocks(self, channel_id, limit=50):
+        """Последние стоки канала [(ts, {предметы каталога})] по возрастанию времени"""
+        rows = self._reader().execute(
+            'SELECT s.id, s.ts, i.target FROM '
+            '(SELECT id, ts FROM stocks WHERE channel_id = ? ORDER BY ts DESC LIMIT ?) s '
+            'LEFT JOIN stock_items i ON i.stock_id = s.id AND i.target IS NOT NULL '
+            'ORDER BY s.ts', (str(channel_id), limit))
+        stocks = OrderedDict()
+        for stock_id, ts, target in rows:
+            entry = stocks.setdefault(stock_id, (ts, set()))
+            if target:
+                entry[1].add(target)
+        return list(stocks.values())
+
+
+history = HistoryStore()
+
+# ==================== ПРОГНОЗ РЕСТОКА ====================
+class RestockPredictor:
+    """Оценивает время следующего стока канала и шанс каждого предмета по последним стокам"""
+
+    def __init__(self, source=None, window=RESTOCK_WINDOW):
+        self.source = source or catalogue   # каталог маршрута: по нему считаются шансы предметов
+        self.window = window
+        self.times = deque(maxlen=window + 1)
+        self.presence = deque(maxlen=window)
+        self.period = None
+        self.probabilities = {}
+        self._predicted_at = None        # прогноз, с которым сравнится следующий сток
+        self._predicted_probabilities = {}
+        self.errors = deque(maxlen=100)
+        self._brier_sum = 0.0
+        self._brier_count = 0
+
+    def seed(self, stocks):
+        """Заполняет окно из истории: [(ts, {предметы}), ...] по возрастанию времени"""
+        for ts, targets in stocks:
+            self.times.append(ts)
+            self.presence.append(set(targets))
+        self._recompute()
+
+    @property
+    def next_at(self):
+        """Ожидаемое время следующего стока; пропущенные окна сдвигаются вперёд"""
+        if self.period is None or not self.times:
+            return None
+        last = self.times[-1]
+        slots = max(1, math.ceil((time.time() - last - self.period / 2) / self.period))
+        return last + slots * self.period
+
+    def _recompute(self):
+        times = list(self.times)
+        gaps = sorted(b - a for a, b in zip(times, times[1:]) if b > a)
+        self.period = gaps[len(gaps) // 2] if len(gaps) >= 2 else None
+        total = len(self.presence)
+        counts = {}
+        for targets in self.presence:
+            for item_name in targets:
+                counts[item_name] = counts.get(item_name, 0) + 1
+        # Сглаживание Лапласа: без истории шанс 50%, а не 0 или 100
+        self.probabilities = {item_name: (counts.get(item_name, 0) + 1) / (total + 2)
+                              for item_name in self.source.current.items}
+        self._predicted_at = self.next_at
+        self._predicted_probabilities = dict(self.probabilities)
+
+    def observe(self, ts, targets):
+        """Учитывает пришедший сток: сначала оценивает точность прошлого прогноза"""
+        if self._predicted_at is not None and self.period and abs(ts - self._predicted_at) < self.period:
+            self.errors.append(ts - self._predicted_at)
+            for item_name, probability in self._predicted_probabilities.items():
+                self._brier_sum += (probability - (1.0 if item_name in targets else 0.0)) ** 2
+                self._brier_count += 1
+        self.times.append(ts)
+        self.presence.append(set(targets))
+        self._recompute()
+
+    def summary(self):
+        next_at = self.next_at
+        errors = list(self.errors)
+        return {
+            'next_at': datetime.fromtimestamp(next_at).isoformat(timespec='seconds') if next_at else None,
+            'seconds_left': round(next_at - time.time(), 1) if next_at else None,
+            'period_seconds': round(self.period, 1) if self.period else None,
+            'stocks_in_window': len(self.presence),
+            'probabilities': {item_name: round(p, 3) for item_name, p in self.probabilities.items()},
+            'accuracy': {
+                'samples': len(errors),
+                'mean_abs_error_seconds': round(sum(abs(e) for e in errors) / len(errors), 1) if errors else None,
+                'brier_score': round(self._brier_sum / self._brier_count, 4) if self._brier_count else None,
+            },
+        }
+
+
+predictors = {}
+warmed_for = None   # прогноз, под который доставка уже прогрета
+
+
+def predictor_for(channel_id, source=None):
+    predictor = predictors.get(channel_id)
+    if predictor is None:
+        predictor = predictors[channel_id] = RestockPredictor(source)
+    return predictor
+
+
+def seed_predictors(stock_routes):
+    """Поднимает окно прогнозов из истории стоков после рестарта"""
+    if not history.enabled:
+        return
+    for route in stock_routes:
+        stocks = history.recent_stocks(route.key, RESTOCK_WINDOW + 1)
+        if stocks:
+            predictor_for(route.key, route.catalogue).seed(stocks)
+            logger.info(f"🔮 Прогноз для {route.name}: {len(stocks)} стоков из истории")
+
+
+async def prewarm(client=None):
+    """Готовит доставку к ожидаемому стоку: соединение с Telegram, payload'ы, проверка шлюза"""
+    started = time.perf_counter()
+    telegram_ok = await telegram.warm()
+
+    for route in routes.stock_routes():
+        for item_config in route.catalogue.current.items.values():
+            if item_config.get('sticker_id'):
+                sticker_request(route.chat_id, item_config['sticker_id'])
+
+    gateway_ok = True
+    if client is not None:
+        gateway_ok = (not client.is_closed() and client.ws is not None
+                      and math.isfinite(client.latency) and client.latency < GATEWAY_LATENCY_LIMIT)
+        if not gateway_ok:
+            logger.warning(f"⚠️ Перед стоком шлюз Discord не в порядке (latency={client.latency})")
+            send_to_bot("⚠️ <b>Скоро сток, а шлюз Discord не отвечает</b>")
+
+    logger.info(f"🔥 Прогрев перед стоком за {(time.perf_counter() - started) * 1000:.0f} мс "
+                f"(Telegram: {'✅' if telegram_ok else '❌'}, шлюз: {'✅' if gateway_ok else '❌'})")
+
+
+async def prewarm_due():
+    """Задача планировщика: будит доставку за PREWARM_LEAD секунд до ожидаемого стока"""
+    global warmed_for
+    upcoming = min((p.next_at for p in predictors.values() if p.next_at), default=None)
+    if upcoming is None or upcoming == warmed_for or upcoming - PREWARM_LEAD > time.time():
+        return
+    warmed_for = upcoming
+    await prewarm(watchdog.client)
+
+# ==================== ОБРАБОТКА СООБЩЕНИЙ ====================
+async def handle_news(message, route):
+    """Пересылает сообщение новостного канала в Telegram"""
+    channel_id = route.key
+    # Защита от дублей
+    if not processed_messages.add(channel_id, message.id):
+        DEDUP_HITS.inc(channel=channel_id)
+        return
+    state.message_processed()
+    
+    logger.info(f"📰 Новость в канале {route.name}")
+
+    # Отправляем текст в Telegram
+    if route.chat_id:
+        news_text = message.content if message.content else "📄 Новость без текста"
+
+        # Добавляем информацию об авторе и времени
+        current_time = datetime.now().strftime('%H:%M:%S')
+        full_news = (
+            f"📰 <b>Новость в {current_time}</b>\n"
+            f"👤 <i>{message.author.name}</i>\n\n"
+            f"{news_text}"
+        )
+
+        send_telegram(route.chat_id, full_news)
+        logger.info("✅ Новость отправлена в Telegram")
+
+
+class TrackedStock:
+    """Что уже известно о стоке по ID сообщения: разобранные куски и предметы, о которых уже сообщили"""
+
+    __slots__ = ('segments', 'content', 'embeds', 'author', 'alerted', 'complete')
+
+    def __init__(self, segments, content, embeds, author, alerted, complete):
+        self.segments = segments
+        self.content = content
+        self.embeds = embeds          # для частичных правок без эмбедов в событии
+        self.author = author          # для частичных правок без автора в событии
+        self.alerted = alerted
+        self.complete = complete      # False — заготовка без позиций, правка пойдёт полным путём
+
+
+class TrackedStocks:
+    """Последние стоки для обработки правок; живут только на event loop, блокировка не нужна"""
+
+    def __init__(self, max_size=EDIT_TRACK_SIZE):
+        self.max_size = max_size
+        self._stocks = OrderedDict()
+
+    def get(self, message_id):
+        return self._stocks.get(message_id)
+
+    def put(self, message, segments, alerted, complete):
+        author = message.author
+        self._stocks[message.id] = TrackedStock(
+            segments, message.content, list(message.embeds or ()),
+            RestAuthor(author.id, author.name, author.bot),
+            set(alerted), complete)
+        self._stocks.move_to_end(message.id)
+        if len(self._stocks) > self.max_size:
+            self._stocks.popitem(last=False)
+
+
+tracked_stocks = TrackedStocks()
+
+
+async def handle_stock(message, route):
+    """Ищет предметы в стоке Kiro и рассылает стикеры и полный сток"""
+    channel_id = route.key
+
+    # Защита от дублей
+    if not processed_messages.add(channel_id, message.id):
+        DEDUP_HITS.inc(channel=channel_id)
+        logger.info(f"⏭️ Пропускаем дубль {message.id}")
+        return
+    state.message_processed()
+    await process_stock(message, route)
+
+
+async def process_stock(message, route, previous_segments=None):
+    """Полный путь стока: разбор, поиск предметов, история, алерты и сток в бота"""
+    channel_id = route.key
+    handler_started = time.perf_counter()
+    if not isinstance(message, RestMessage):
+        # Задержку шлюза меряем только по MESSAGE_CREATE: у опроса REST и правок created_at давний
+        GATEWAY_LATENCY.observe(message_age(message), channel=channel_id)
+    posted_at = message.created_at.timestamp()
+
+    logger.info(f"📨 Сообщение от Kiro (ID: {message.id})")
+
+    # Ищем предметы в разобранных позициях; общий текст нужен только для вывода
+    snapshot = route.catalogue.current
+    items = snapshot.items
+    with PARSE_SECONDS.time():
+        segments, _ = parse_stock_segments(message, previous_segments)
+        records = segment_records(segments)
+    rendered = None
+    if records:
+        logger.info(f"📋 Разобрано позиций стока: {len(records)}")
+        with MATCH_SECONDS.time():
+            matches = snapshot.matcher.match_records(records)
+    else:
+        rendered = render_stock(message)
+        if not rendered.text:
+            # Заготовка: Kiro может дописать эмбед правкой — запоминаем, чтобы не потерять сток
+            tracked_stocks.put(message, segments, (), complete=False)
+            STOCKS_PROCESSED.inc(channel=channel_id, result='empty')
+            logger.info("📭 Сообщение пустое")
+            return
+        logger.info(f"📋 Полный сток ({len(rendered.text)} символов)")
+        with MATCH_SECONDS.time():
+            matches = {item_name: (item_match, None)
+                       for item_name, item_match in snapshot.matcher.match(rendered.text).items()}
+    found_items = list(matches)
+    tracked_stocks.put(message, segments, found_items, complete=True)
+
+    for item_name, (item_match, record) in matches.items():
+        logger.info(f"🎯 Найдено: {item_match.keyword} → {format_found_item(items[item_name], record)}")
+
+    current_time = datetime.now().strftime('%H:%M:%S')
+
+    state.add_found(found_items)
+    # Время стока — публикация в Discord, а не обработка: догнанные опросом стоки не сбивают интервалы
+    history.record(channel_id, message.id, records, matches, ts=posted_at)
+    predictor_for(channel_id, route.catalogue).observe(posted_at, found_items)
+
+    # Сравниваем с прошлым стоком канала: алерты только по изменившимся позициям
+    diff = stock_differ.update(channel_id, build_stock_snapshot(records, matches, items), message.id)
+    if diff.full:
+        alerts = matches
+        if rendered is None:
+            rendered = render_stock(message)
+    else:
+        alerts = {item_name: match for item_name, match in matches.items()
+                  if diff.fresh(snapshot_key(item_name, match[1]))}
+
+    if alerts:
+        # Стикеры в канал — подряд одним блоком очереди, по одному запросу
+        send_item_alerts(route.chat_id, items, alerts, route.alert_mode)
+        for item_name in alerts:
+            item_config = items[item_name]
+            logger.info(f"✅ {item_config['emoji']} {item_config['display_name']} в {current_time}")
+
+    if diff.full and found_items:
+        # Полный сток в бота
+        found_items_list = "\n".join(
+            f"• {format_found_item(items[name], record)}" for name, (_, record) in matches.items()
+        )
+
+        header = (
+            f"🎯 <b>Обнаружены предметы в {current_time}:</b>\n"
+            f"{found_items_list}\n\n"
+            f"📋 <b>Полный сток:</b>\n"
+        )
+
+        send_stock_to_bot(header, rendered, "\n\n#сток", route.log_chat_id)
+        STOCKS_PROCESSED.inc(channel=channel_id, result='found')
+        logger.info(f"📨 Полный сток отправлен в бота ({len(found_items)} предметов, "
+                    f"{len(rendered.pieces)} сообщ.)")
+
+    elif diff.full:
+        logger.info("📭 Целевые предметы не найдены")
+
+        header = (
+            f"📊 <b>Сток от Kiro в {current_time}</b>\n"
+            f"🎯 Целевые предметы: не найдены\n\n"
+            f"📋 <b>Полный сток:</b>\n"
+        )
+        send_stock_to_bot(header, rendered, chat_id=route.log_chat_id)
+        STOCKS_PROCESSED.inc(channel=channel_id, result='not_found')
+        logger.info("📨 Пустой сток отправлен в бота")
+
+    elif diff:
+        # Только изменения относительно прошлого стока
+        alerts_list = "\n".join(
+            f"• {format_found_item(items[name], record)}" for name, (_, record) in alerts.items()
+        )
+        text = (
+            f"🔁 <b>Изменения стока в {current_time}</b>\n"
+            + (f"🎯 <b>Новые целевые предметы:</b>\n{alerts_list}\n\n" if alerts else "")
+            + format_stock_diff(diff)
+            + "\n\n#сток"
+        )
+        if route.log_chat_id:
+            for chunk in split_lines(text, TELEGRAM_MESSAGE_LIMIT):
+                send_telegram(route.log_chat_id, chunk)
+        STOCKS_PROCESSED.inc(channel=channel_id, result='diff')
+        logger.info(f"📨 Изменения стока отправлены в бота (+{len(diff.added)} "
+                    f"~{len(diff.changed)} -{len(diff.removed)})")
+
+    else:
+        STOCKS_PROCESSED.inc(channel=channel_id, result='unchanged')
+        logger.info("💤 Сток не изменился, уведомления не нужны")
+
+    HANDLER_SECONDS.observe(time.perf_counter() - handler_started, channel=channel_id)
 
-# ==================== НАСТРОЙКА ЛОГГИНГА ====================
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
 
-# ==================== ПРОВЕРКА ВЕРСИИ ====================
-print(f"🚀 Python: {sys.version}")
+async def handle_stock_edit(message, route, tracked):
+    """Правка стока: заново разбираются только изменившиеся куски, алерты — только по новым предметам"""
+    channel_id = route.key
+    if tracked is None:
+        if (channel_id, message.id) in processed_messages:
+            STOCK_EDITS.inc(channel=channel_id, result='untracked')
+            return  # сток уже обработан, но выпал из памяти правок — сравнить не с чем
+        if message_age(message) > FALLBACK_MAX_AGE:
+            # Правка старого поста, который уже выпал из кеша дублей (или после рестарта) — сток давно неактуален
+            STOCK_EDITS.inc(channel=channel_id, result='stale')
+            logger.info(f"⏭️ Правка старого стока {message.id}, пропускаем")
+            return
+        STOCK_EDITS.inc(channel=channel_id, result='new')
+        await handle_stock(message, route)
+        return
 
-# ==================== НАСТРОЙКИ ====================
-DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
-TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
-TELEGRAM_BOT_CHAT_ID = os.getenv('TELEGRAM_BOT_CHAT_ID')
-RENDER_SERVICE_URL = os.getenv('RENDER_SERVICE_URL', 'https://stock-bot-cj4s.onrender.com')
+    if not tracked.complete:
+        logger.info(f"✏️ Заготовка стока {message.id} заполнена правкой")
+        STOCK_EDITS.inc(channel=channel_id, result='completed')
+        await process_stock(message, route, tracked.segments)
+        return
 
-# НОВЫЕ ПЕРЕМЕННЫЕ:
-STOCKS_CHANNEL_ID = os.getenv('STOCKS_CHANNEL_ID')           # ID канала со стоками
-STOCKS_TELEGRAM_CHANNEL = os.getenv('STOCKS_TELEGRAM_CHANNEL')  # Куда отправлять стикеры
-NEWS_CHANNEL_ID = os.getenv('NEWS_CHANNEL_ID')               # ID новостного канала
-NEWS_TELEGRAM_CHANNEL = os.getenv('NEWS_TELEGRAM_CHANNEL')   # Куда отправлять новости
+    with PARSE_SECONDS.time():
+        segments, reparsed = parse_stock_segments(message, tracked.segments)
+    if not reparsed and message.content == tracked.content and len(segments) == len(tracked.segments):
+        STOCK_EDITS.inc(channel=channel_id, result='unchanged')
+        return
 
-# Проверка обязательных переменных
-REQUIRED_VARS = ['DISCORD_TOKEN', 'TELEGRAM_TOKEN', 'STOCKS_CHANNEL_ID', 'STOCKS_TELEGRAM_CHANNEL']
-missing = [var for var in REQUIRED_VARS if not os.getenv(var)]
-if missing:
-    logger.error(f'❌ Отсутствуют переменные: {missing}')
-    exit(1)
-
-logger.info(f"📦 Канал стоков: {STOCKS_CHANNEL_ID}")
-logger.info(f"📢 Telegram для стоков: {STOCKS_TELEGRAM_CHANNEL}")
-if NEWS_CHANNEL_ID and NEWS_TELEGRAM_CHANNEL:
-    logger.info(f"📰 Канал новостей: {NEWS_CHANNEL_ID}")
-    logger.info(f"📢 Telegram для новостей: {NEWS_TELEGRAM_CHANNEL}")
-logger.info(f"🤖 Бот Telegram: {TELEGRAM_BOT_CHAT_ID}")
+    snapshot = route.catalogue.current
+    items = snapshot.items
+    records = segment_records(segments)
+    with MATCH_SECONDS.time():
+        if records:
+            matches = snapshot.matcher.match_records(records)
+        else:
+            matches = {item_name: (item_match, None)
+                       for item_name, item_match in snapshot.matcher.match(render_stock(message).text).items()}
+    fresh = {item_name: match for item_name, match in matches.items() if item_name not in tracked.alerted}
 
-# ==================== ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ====================
-bot_start_time = datetime.now()
-ping_count = 0
-last_ping_time = None
-found_items_count = {}
-processed_messages = set()
-MAX_CACHE_SIZE = 50
+    tracked.segments = segments
+    tracked.content = message.content
+    tracked.embeds = list(message.embeds or ())
+    tracked.alerted.update(fresh)
+    stock_differ.replace(channel_id, message.id, build_stock_snapshot(records, matches, items))
 
-# ==================== КОНФИГУРАЦИЯ ПРЕДМЕТОВ ====================
-TARGET_ITEMS = {
-    'cherry': {
-        'keywords': ['cherry', 'cherry seed', '🍒'],
-        'sticker_id': "CAACAgIAAxkBAAEQnoFpnyHlfKoDssWIpZHbKrjgBUkgAQACy5AAAv894EjYncv41k4_XzoE",
-        'emoji': '🍒',
-        'display_name': 'Cherry'
-    },
-    'cabbage': {
-        'keywords': ['cabbage', 'cabbage seed', '🥬'],
-        'sticker_id': "CAACAgIAAxkBAAEQnoNpnyHvhLutfLJmqqqqk8_TWy-8wAACZ5YAAho06UipuXAdrrQYXToE",
-        'emoji': '🥬',
-        'display_name': 'Cabbage'
-    },
-    'super_sprinkler': {
-        'keywords': ['super sprinkler'],  # Только точная фраза
-        'sticker_id': "CAACAgIAAxkBAAEQnoVpnyH24p9XG865neBZzotLJBqyTwACzp0AAtmT-UgP-Ruhrq3S3joE",
-        'emoji': '💧',
-        'display_name': 'Super Sprinkler'
-    }
-}
+    if not fresh:
+        STOCK_EDITS.inc(channel=channel_id, result='no_new_items')
+        logger.info(f"✏️ Правка стока {message.id}: новых предметов нет (разобрано кусков: {reparsed})")
+        return
 
-# Инициализируем счетчики
-for item_name in TARGET_ITEMS.keys():
-    found_items_count[item_name] = 0
+    send_item_alerts(route.chat_id, items, fresh, route.alert_mode)
+    state.add_found(list(fresh))
+    if route.log_chat_id:
+        fresh_list = "\n".join(
+            f"• {format_found_item(items[name], record)}" for name, (_, record) in fresh.items()
+        )
+        send_telegram(route.log_chat_id,
+                      f"✏️ <b>Сток дополнен в {datetime.now().strftime('%H:%M:%S')}</b>\n{fresh_list}\n\n#сток")
+    STOCK_EDITS.inc(channel=channel_id, result='new_items')
+    logger.info(f"✏️ Правка стока {message.id}: новые предметы {', '.join(fresh)}")
 
-# ==================== TELEGRAM ФУНКЦИИ ====================
-def send_telegram(chat_id, text, parse_mode="HTML"):
+
+async def handle_message_edit(data, bot_user=None):
+    """Точка входа для правок: сырое событие MESSAGE_UPDATE из on_raw_message_edit и из replay.py"""
     try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-        data = {"chat_id": chat_id, "text": text, "parse_mode": parse_mode}
-        response = requests.post(url, json=data, timeout=10)
+        route = routes.get(int(data['channel_id']))
+        if route is None or route.kind != 'stock':
+            return
+        
+        tracked = tracked_stocks.get(int(data['id']))
+        if 'author' not in data and tracked is None:
+            # Частичное событие (например, подгрузка эмбедов): автор проверен при первом показе
+            return
+        
+        message = RestMessage(data, route)
+        if tracked is not None:
+            # В частичном событии только изменившиеся поля: отсутствующие не значат «удалены»
+            if 'author' not in data:
+                message.author = tracked.author
+            if 'content' not in data:
+                message.content = tracked.content
+            if 'embeds' not in data:
+                message.embeds = tracked.embeds
+        if bot_user is not None and message.author.id == bot_user.id:
+            return
+        reason = route.reject_reason(message)
+        if reason:
+            MESSAGES_REJECTED.inc(reason=reason)
+            return
+        
+        await handle_stock_edit(message, route, tracked)
         
-        if response.status_code == 200:
-            logger.info(f"✅ Telegram отправлено в {chat_id}")
-            return True
-        elif response.status_code == 429:
-            retry_after = response.json().get('parameters', {}).get('retry_after', 30)
-            logger.warning(f"⚠️ Лимит Telegram, жду {retry_after} сек")
-            time.sleep(retry_after)
-            return False
-        else:
-            logger.error(f"❌ Telegram ошибка {response.status_code}: {response.text[:100]}")
-            return False
     except Exception as e:
-        logger.error(f'❌ Telegram error: {e}')
-        return False
+        logger.error(f"💥 Ошибка обработки правки: {e}")
+        send_to_bot(f"⚠️ <b>Ошибка обработки правки:</b>\n<code>{str(e)[:200]}</code>")
 
-def send_to_bot(text):
-    """Отправляет сообщение в личку бота"""
-    if TELEGRAM_BOT_CHAT_ID:
-        return send_telegram(TELEGRAM_BOT_CHAT_ID, text)
-    return False
 
-def send_telegram_sticker(chat_id, sticker_id):
-    """Отправляет стикер в Telegram"""
+async def handle_message(message, bot_user=None):
+    """Точка входа конвейера: вызывается из on_message и из стенда replay.py"""
     try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendSticker"
-        data = {"chat_id": chat_id, "sticker": sticker_id}
-        response = requests.post(url, json=data, timeout=10)
-        if response.status_code == 200:
-            logger.info(f"📢 Стикер отправлен в канал")
-            return True
+        # Префильтр: чужие каналы и авторы отсекаются по ID, до любой работы с текстом
+        route = routes.get(message.channel.id)
+        if route is None:
+            MESSAGES_REJECTED.inc(reason='channel')
+            return
+        
+        if bot_user is not None and message.author.id == bot_user.id:
+            MESSAGES_REJECTED.inc(reason='self')
+            return
+        reason = route.reject_reason(message)
+        if reason:
+            MESSAGES_REJECTED.inc(reason=reason)
+            return
+        MESSAGES_ACCEPTED.inc(route=route.name)
+        
+        if route.kind == 'news':
+            await handle_news(message, route)
         else:
-            logger.error(f"❌ Ошибка отправки стикера: {response.status_code}")
-            return False
+            await handle_stock(message, route)
+        
     except Exception as e:
-        logger.error(f'❌ Ошибка отправки стикера: {e}')
-        return False
+        logger.error(f"💥 Ошибка обработки сообщения: {e}")
+        error_msg = f"⚠️ <b>Ошибка обработки сообщения:</b>\n<code>{str(e)[:200]}</code>"
+        send_to_bot(error_msg)
 
-# ==================== ИЗВЛЕЧЕНИЕ ТЕКСТА ====================
-def extract_full_content(message):
-    """Извлекает весь текст из сообщения Discord"""
-    full_content = ""
-    
-    # 1. Текст сообщения
-    if message.content:
-        full_content += f"{message.content}\n\n"
-    
-    # 2. Эмбеды
-    if message.embeds:
-        for embed in message.embeds:
-            if embed.title:
-                full_content += f"{embed.title}\n"
-            if embed.description:
-                full_content += f"{embed.description}\n"
-            if embed.fields:
-                for field in embed.fields:
-                    full_content += f"\n{field.name}\n{field.value}\n"
-            if embed.footer and embed.footer.text:
-                full_content += f"\n{embed.footer.text}\n"
-    
-    # 3. Очистка
-    import re
-    full_content = re.sub(r'<:[^:]+:\d+>', '', full_content)
-    full_content = re.sub(r'\*\*', '', full_content)
-    full_content = html.escape(full_content)
-    full_content = '\n'.join([line.strip() for line in full_content.split('\n') if line.strip()])
-    
-    return full_content.strip()
+# ==================== РЕЗЕРВНЫЙ ОПРОС ====================
+DISCORD_EPOCH = 1420070400000
 
-# ==================== САМОПИНГ ====================
-def self_pinger():
-    global ping_count, last_ping_time
-    
-    logger.info("🏓 Запуск самопинга (каждые 8 минут)")
-    time.sleep(30)
-    
-    while True:
-        try:
-            ping_count += 1
-            last_ping_time = datetime.now()
-            
+
+def snowflake_time(snowflake):
+    return datetime.fromtimestamp(((snowflake >> 22) + DISCORD_EPOCH) / 1000, tz=timezone.utc)
+
+
+def time_snowflake(ts):
+    """Наименьший ID сообщения, созданного в момент ts (unix-время)"""
+    return max(0, int(ts * 1000) - DISCORD_EPOCH) << 22
+
+
+def message_age(message):
+    """Сколько секунд прошло с публикации сообщения"""
+    return (datetime.now(timezone.utc) - message.created_at).total_seconds()
+
+
+class RestAuthor:
+    __slots__ = ('id', 'name', 'bot')
+
+    def __init__(self, id, name, bot):
+        self.id = id
+        self.name = name
+        self.bot = bot
+
+
+class RestRef:
+    """Канал или сервер, от которого конвейеру нужен только id"""
+
+    __slots__ = ('id',)
+
+    def __init__(self, id):
+        self.id = id
+
+
+class RestMessage:
+    """Сообщение из JSON (REST API или сырое событие шлюза) с интерфейсом disnake.Message для общего конвейера"""
+
+    __slots__ = ('id', 'channel', 'guild', 'author', 'webhook_id', 'application_id',
+                 'content', 'embeds', 'created_at')
+
+    def __init__(self, data, route):
+        author = data.get('author') or {}
+        self.id = int(data['id'])
+        self.channel = route.channel_ref
+        self.guild = route.guild_ref
+        self.author = RestAuthor(int(author.get('id', 0)), author.get('username', ''), author.get('bot', False))
+        self.webhook_id = int(data['webhook_id']) if data.get('webhook_id') else None
+        self.application_id = int(data['application_id']) if data.get('application_id') else None
+        self.content = data.get('content', '')
+        self.embeds = [discord.Embed.from_dict(embed) for embed in data.get('embeds', ())]
+        self.created_at = snowflake_time(self.id)
+
+
+class FallbackPoller:
+    """Догоняет каналы маршрутов через REST, пока шлюз лежит: сообщения после курсора идут в handle_message.
+
+    Курсор — последний обработанный ID канала (кеш дублей сохраняется на диск), так что
+    после рестарта опрос продолжает с того же места, а дубли со шлюза отсекаются как обычно.
+    """
+
+    def __init__(self, api_url=DISCORD_API_URL, token=DISCORD_TOKEN,
+                 interval=FALLBACK_POLL_INTERVAL, max_age=FALLBACK_MAX_AGE):
+        self.api_url = api_url.rstrip('/')
+        self.token = token
+        self.interval = interval
+        self.max_age = max_age
+        self.page_size = FALLBACK_PAGE_SIZE
+        self.cursors = {}
+        self.bot_user = None
+        self._session = None
+        self._task = None
+        self._resumed = None
+        self._not_before = 0.0
+        self.gap_started_at = None
+        self.recovered = 0
+
+    def cursor(self, route):
+        last = processed_messages.last_id(route.key) or 0
+        return max(self.cursors.get(route.channel_id, 0), last) or None
+
+    async def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers={'Authorization': f'Bot {self.token}', 'User-Agent': 'stock-bot (fallback poller)'},
+                timeout=aiohttp.ClientTimeout(total=15))
+        return self._session
+
+    async def _request(self, path, params):
+        """GET с соблюдением лимитов: ждём X-RateLimit-Reset-After при нуле остатка и retry_after на 429"""
+        session = await self._get_session()
+        for _ in range(5):
+            wait = self._not_before - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            async with session.get(f"{self.api_url}{path}", params=params) as response:
+                FALLBACK_REQUESTS.inc(status=response.status)
+                if response.headers.get('X-RateLimit-Remaining') == '0':
+                    reset_after = float(response.headers.get('X-RateLimit-Reset-After', 1))
+                    self._not_before = time.monotonic() + reset_after
+                if response.status == 429:
+                    data = await response.json(content_type=None)
+                    retry_after = float(data.get('retry_after', 1))
+                    logger.warning(f"⏳ REST Discord: лимит, ждём {retry_after:.1f} сек")
+                    self._not_before = time.monotonic() + retry_after
+                    continue
+                if response.status != 200:
+                    logger.warning(f"⚠️ REST Discord {path}: статус {response.status}")
+                    return None
+                return await response.json()
+        return None
+
+    async def fetch_after(self, route, after):
+        """Страницы сообщений канала после after, по возрастанию ID; каждая отдаётся сразу, как пришла"""
+        while True:
+            page = await self._request(f"/channels/{route.channel_id}/messages",
+                                       {'after': str(after), 'limit': str(self.page_size)})
+            if not page:
+                break
+            page.sort(key=lambda data: int(data['id']))
+            yield page
+            after = int(page[-1]['id'])
+            if len(page) < self.page_size:
+                break
+
+    async def catch_up(self):
+        """Один проход по всем маршрутам; возвращает число сообщений, отданных в конвейер"""
+        handled = 0
+        for route in routes:
+            after = self.cursor(route)
+            if after is None:
+                continue  # канал ещё ни разу не обрабатывался — историю не поднимаем
+            # После долгого простоя не листаем то, что всё равно отбросим как устаревшее
+            after = max(after, time_snowflake(time.time() - self.max_age))
             try:
-                response = requests.get(f"{RENDER_SERVICE_URL}/health", timeout=15)
-                if response.status_code == 200:
-                    logger.info(f"🏓 Самопинг #{ping_count} успешен")
-                    
-                    if ping_count % 10 == 0:
-                        uptime = datetime.now() - bot_start_time
-                        hours = uptime.total_seconds() / 3600
-                        
-                        stats = []
-                        for item_name, count in found_items_count.items():
-                            if count > 0:
-                                item = TARGET_ITEMS[item_name]
-                                stats.append(f"{item['emoji']} {item['display_name']}: {count}")
-                        
-                        stats_text = "\n".join(stats) if stats else "Пока ничего не найдено"
-                        
-                        status = (
-                            f"📊 <b>Статус самопинга #{ping_count}</b>\n"
-                            f"⏰ Работает: {hours:.1f} часов\n"
-                            f"🕒 Последний пинг: {last_ping_time.strftime('%H:%M:%S')}\n"
-                            f"✅ WebSocket активен\n"
-                            f"📊 Обработано сообщений: {len(processed_messages)}\n\n"
-                            f"🏆 <b>Найдено предметов:</b>\n"
-                            f"{stats_text}"
-                        )
-                        send_to_bot(status)
-                else:
-                    logger.warning(f"⚠️ Самопинг: статус {response.status_code}")
-                    
-            except requests.exceptions.Timeout:
-                logger.warning("⏰ Таймаут самопинга")
-            except requests.exceptions.ConnectionError:
-                logger.warning("🔌 Ошибка соединения при самопинге")
-            except Exception as e:
-                logger.error(f"❌ Ошибка запроса самопинга: {e}")
-            
-            logger.info("💤 Ожидаю 8 минут до следующего самопинга...")
-            time.sleep(480)
-            
+                async for page in self.fetch_after(route, after):
+                    for data in page:
+                        message = RestMessage(data, route)
+                        self.cursors[route.channel_id] = message.id
+                        if message_age(message) > self.max_age:
+                            FALLBACK_MESSAGES.inc(channel=route.key, result='stale')
+                            continue
+                        FALLBACK_MESSAGES.inc(channel=route.key, result='handled')
+                        await handle_message(message, self.bot_user)
+                        handled += 1
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"⚠️ Резервный опрос {route.name}: {e!r}")
+                continue
+        if handled:
+            self.recovered += handled
+            logger.info(f"🛟 Резервный опрос: обработано {handled} сообщений")
+        return handled
+
+    async def _run(self):
+        try:
+            while True:
+                await self.catch_up()
+                # После восстановления шлюза — ещё один проход, чтобы закрыть хвост разрыва
+                if self._resumed.is_set():
+                    break
+                try:
+                    await asyncio.wait_for(self._resumed.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
         except Exception as e:
-            logger.error(f"💥 Критическая ошибка в самопинге: {e}")
-            logger.info("🔄 Перезапуск самопинга через 30 секунд...")
-            time.sleep(30)
-            continue
+            logger.error(f"❌ Ошибка резервного опроса: {e}")
 
-# ==================== FLASK СЕРВЕР ====================
-app = Flask(__name__)
+    def _ensure_task(self):
+        if self._resumed is None:
+            self._resumed = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def gateway_lost(self):
+        """Шлюз отключился: опрашиваем REST каждые interval секунд до восстановления"""
+        if self._resumed is None:
+            self._resumed = asyncio.Event()
+        self._resumed.clear()
+        if self.gap_started_at is None:
+            self.gap_started_at = time.time()
+        self._ensure_task()
+
+    def gateway_restored(self, bot_user=None):
+        """Шлюз снова на связи (RESUME или новый IDENTIFY): последний проход и стоп"""
+        if bot_user is not None:
+            self.bot_user = bot_user
+        if self._resumed is None:
+            self._resumed = asyncio.Event()
+        self._resumed.set()
+        self.gap_started_at = None
+        self._ensure_task()
+
+    def stats(self):
+        return {
+            'polling': self._task is not None and not self._task.done(),
+            'gap_started_at': datetime.fromtimestamp(self.gap_started_at).isoformat() if self.gap_started_at else None,
+            'recovered_messages': self.recovered,
+            'cursors': {str(channel_id): str(cursor) for channel_id, cursor in self.cursors.items()},
+        }
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+poller = FallbackPoller()
+
+# ==================== ПЛАНИРОВЩИК ====================
+class ScheduledJob:
+    __slots__ = ('name', 'interval', 'func', 'blocking', 'runs', 'failures', 'running',
+                 'last_duration', 'last_lateness')
+
+    def __init__(self, name, interval, func, blocking=False):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.blocking = blocking          # синхронная функция с диском — в пул потоков, а не на цикл
+        self.runs = 0
+        self.failures = 0
+        self.running = False
+        self.last_duration = None
+        self.last_lateness = None
+
+
+class Scheduler:
+    """Периодические задачи на event loop бота: одна куча сроков и один таймер вместо потоков со sleep"""
+
+    def __init__(self):
+        self.jobs = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._task = None
+
+    def every(self, name, interval, func, delay=None, blocking=False):
+        """Запускать func каждые interval секунд; первый раз — через delay (по умолчанию interval)"""
+        job = self.jobs[name] = ScheduledJob(name, interval, func, blocking)
+        self._push(time.monotonic() + (interval if delay is None else delay), job)
+        return job
+
+    def _push(self, due, job):
+        heapq.heappush(self._heap, (due, next(self._seq), job))
+
+    def start(self):
+        if self._task is None and self._heap:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            due, _, job = self._heap[0]
+            wait = due - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            heapq.heappop(self._heap)
+            job.last_lateness = -wait
+            # Сроки не плывут от длительности задач; после долгого простоя пропущенные запуски не копятся
+            next_due = due + job.interval
+            self._push(next_due if next_due > time.monotonic() else time.monotonic() + job.interval, job)
+            if job.running:
+                continue  # прошлый запуск ещё идёт — не наслаиваем
+            asyncio.get_running_loop().create_task(self._execute(job))
+
+    async def _execute(self, job):
+        job.running = True
+        started = time.perf_counter()
+        try:
+            if job.blocking:
+                await asyncio.get_running_loop().run_in_executor(None, job.func)
+            else:
+                result = job.func()
+                if asyncio.iscoroutine(result):
+                    await result
+            job.runs += 1
+        except Exception as e:
+            job.failures += 1
+            logger.error(f"❌ Задача {job.name}: {e!r}")
+        finally:
+            job.running = False
+            job.last_duration = time.perf_counter() - started
+
+    def stats(self):
+        return {
+            job.name: {
+                'interval': job.interval,
+                'runs': job.runs,
+                'failures': job.failures,
+                'last_duration_ms': round(job.last_duration * 1000, 1) if job.last_duration is not None else None,
+                'last_lateness_ms': round(job.last_lateness * 1000, 1) if job.last_lateness is not None else None,
+            }
+            for job in list(self.jobs.values())
+        }
+
+
+scheduler = Scheduler()
+
+
+async def keep_alive():
+    """Входящий запрос на публичный адрес: Render усыпляет сервис без внешнего трафика,
+    поэтому внутренний таймер его не заменяет. Идёт через общую сессию aiohttp, без потоков."""
+    ping_number = state.record_ping()
+    session = await telegram.get_session()
+    try:
+        async with session.get(f"{RENDER_SERVICE_URL}/healthz") as response:
+            if response.status == 200:
+                logger.info(f"🏓 Самопинг #{ping_number} успешен")
+            else:
+                logger.warning(f"⚠️ Самопинг: статус {response.status}")
+    except asyncio.TimeoutError:
+        logger.warning("⏰ Таймаут самопинга")
+    except aiohttp.ClientError as e:
+        logger.warning(f"🔌 Ошибка соединения при самопинге: {e!r}")
 
-@app.route('/')
-def home():
+
+def status_digest():
+    """Сводка в бота: аптайм, пинги, обработанные сообщения и находки"""
     uptime = datetime.now() - bot_start_time
-    uptime_str = str(uptime).split('.')[0]
-    
-    stats = []
-    for item_name, count in found_items_count.items():
-        if count > 0:
-            item = TARGET_ITEMS[item_name]
-            stats.append(f"{item['emoji']} {item['display_name']}: {count}")
-    
-    news_status = "✅ Подключен" if NEWS_CHANNEL_ID else "❌ Не настроен"
-    
-    return f"""
+    current = state.snapshot()
+    stats = current.found_stats(routes.all_items())
+    stats_text = "\n".join(html.escape(stat) for stat in stats) if stats else "Пока ничего не найдено"
+    last_ping = current.last_ping_time.strftime('%H:%M:%S') if current.last_ping_time else '—'
+    send_to_bot(
+        f"📊 <b>Статус бота</b>\n"
+        f"⏰ Работает: {uptime.total_seconds() / 3600:.1f} часов\n"
+        f"🏓 Самопингов: {current.ping_count}, последний: {last_ping}\n"
+        f"✅ WebSocket: {'активен' if watchdog.heartbeat_age() is not None else 'переподключается'}\n"
+        f"📊 Обработано сообщений: {current.processed}\n\n"
+        f"🏆 <b>Найдено предметов:</b>\n"
+        f"{stats_text}"
+    )
+
+
+async def save_snapshots():
+    """Периодический снапшот очереди Telegram и кеша дублей — на случай падения без finally"""
+    # Очереди копируются здесь, на цикле; на диск пишет пул потоков
+    jobs = outbox.pending()
+    await asyncio.get_running_loop().run_in_executor(None, _write_snapshots, jobs)
+
+
+def _write_snapshots(jobs):
+    outbox.save(jobs)
+    processed_messages.save()
+
+
+class MetricRollup:
+    """Поминутные приращения счётчиков за последний час — темпы для /health без Prometheus"""
+
+    def __init__(self, counters, minutes=60):
+        self.counters = counters
+        self.minutes = deque(maxlen=minutes)
+        self._last = None
+
+    def _totals(self):
+        return {name: sum(counter.snapshot().values()) for name, counter in self.counters.items()}
+
+    def roll(self):
+        totals = self._totals()
+        if self._last is not None:
+            self.minutes.append({name: totals[name] - self._last.get(name, 0) for name in totals})
+        self._last = totals
+
+    def summary(self):
+        minutes = list(self.minutes)
+        return {
+            name: {
+                'last_minute': minutes[-1][name] if minutes else None,
+                'last_hour': sum(minute[name] for minute in minutes),
+            }
+            for name in self.counters
+        }
+
+
+rollup = MetricRollup({
+    'messages_accepted': MESSAGES_ACCEPTED,
+    'messages_rejected': MESSAGES_REJECTED,
+    'stocks': STOCKS_PROCESSED,
+    'telegram_requests': TELEGRAM_REQUESTS,
+    'fallback_messages': FALLBACK_MESSAGES,
+})
+
+
+class GatewayWatchdog:
+    """Следит за возрастом последнего heartbeat ACK шлюза и перезапускает клиент Discord без рестарта процесса"""
+
+    def __init__(self, stall_after=WATCHDOG_STALL):
+        self.stall_after = stall_after
+        self.client = None
+        self.restart_requested = False
+        self.restarts = 0
+        self._no_gateway_since = None
+        self._last_restart = 0.0
+
+    def heartbeat_age(self):
+        """Секунд с последнего ACK heartbeat; None — соединения со шлюзом сейчас нет"""
+        client = self.client
+        ws = client.ws if client is not None else None
+        keep_alive = getattr(ws, '_keep_alive', None)
+        if keep_alive is None:
+            return None
+        return time.perf_counter() - keep_alive._last_ack
+
+    async def check(self):
+        client = self.client
+        if client is None or client.is_closed():
+            return
+        age = self.heartbeat_age()
+        now = time.monotonic()
+        if age is None:
+            # Переподключение disnake может зависнуть — считаем, сколько шлюза нет вовсе
+            if self._no_gateway_since is None:
+                self._no_gateway_since = now
+            stalled_for = now - self._no_gateway_since
+        else:
+            self._no_gateway_since = None
+            stalled_for = age
+        if stalled_for < self.stall_after or now - self._last_restart < self.stall_after:
+            return
+        await self.restart(f"нет heartbeat {stalled_for:.0f} сек")
+
+    async def restart(self, reason):
+        logger.warning(f"🐶 Watchdog: {reason}, перезапускаю клиент Discord")
+        send_to_bot(f"🐶 <b>Watchdog перезапускает Discord</b>\n{html.escape(reason)}")
+        self.restarts += 1
+        self._last_restart = time.monotonic()
+        self._no_gateway_since = None
+        self.restart_requested = True
+        poller.gateway_lost()
+        await self.client.close()
+
+    def stats(self):
+        age = self.heartbeat_age()
+        return {
+            'heartbeat_age_seconds': round(age, 1) if age is not None else None,
+            'stall_after_seconds': self.stall_after,
+            'restarts': self.restarts,
+        }
+
+
+watchdog = GatewayWatchdog()
+
+
+def schedule_jobs():
+    if RENDER_SERVICE_URL:
+        scheduler.every('keep_alive', KEEPALIVE_INTERVAL, keep_alive)
+    scheduler.every('status_digest', STATUS_DIGEST_INTERVAL, status_digest)
+    scheduler.every('snapshots', SNAPSHOT_INTERVAL, save_snapshots)
+    scheduler.every('metric_rollup', 60, rollup.roll, delay=0)
+    scheduler.every('watchdog', WATCHDOG_INTERVAL, watchdog.check)
+    scheduler.every('prewarm', PREWARM_CHECK_INTERVAL, prewarm_due)
+    # Файлы каталогов всех маршрутов: stat и перечитывание — в пуле потоков
+    for path, route_catalogue in routes.catalogues.items():
+        scheduler.every(f'catalogue:{path}', ITEMS_RELOAD_INTERVAL, route_catalogue.maybe_reload, blocking=True)
+        logger.info(f"👀 Слежу за каталогом {path} (каждые {ITEMS_RELOAD_INTERVAL:g} сек)")
+
+# ==================== FLASK СЕРВЕР ====================
+DASHBOARD_TEMPLATE = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -251,30 +2957,30 @@ def home():
         <div class="card">
             <h2>📊 Статус системы</h2>
             <p><strong>Состояние:</strong> <span class="status-ok">✅ WebSocket активен</span></p>
-            <p><strong>Время работы:</strong> {uptime_str}</p>
+            <p><strong>Время работы:</strong> <span id="uptime" data-start="{start_epoch}">с {start_str}</span></p>
             <p><strong>Самопингов:</strong> {ping_count}</p>
-            <p><strong>Обработано сообщений:</strong> {len(processed_messages)}</p>
+            <p><strong>Обработано сообщений:</strong> {processed}</p>
         </div>
         
         <div class="card">
             <h2>📦 Каналы мониторинга</h2>
-            <p><strong>Стоки:</strong> {STOCKS_CHANNEL_ID}</p>
-            <p><strong>Новости:</strong> {NEWS_CHANNEL_ID or 'Не настроен'} ({news_status})</p>
+            <ul>{channels}</ul>
         </div>
         
         <div class="card">
             <h2>🎯 Отслеживаемые предметы</h2>
-            <ul>
-                <li>🍒 Cherry</li>
-                <li>🥬 Cabbage</li>
-                <li>💧 Super Sprinkler (только точное совпадение)</li>
-            </ul>
+            <ul>{tracked}</ul>
             <p><em>📨 В канал: стикер<br>🤖 В бота: полный сток</em></p>
         </div>
         
+        <div class="card">
+            <h2>🔮 Прогноз рестока</h2>
+            {forecasts}
+        </div>
+        
         <div class="card">
             <h2>🏆 Найдено предметов</h2>
-            <ul>{"".join([f'<li>{stat}</li>' for stat in stats]) if stats else '<li>Пока ничего не найдено</li>'}</ul>
+            <ul>{stats}</ul>
         </div>
         
         <div class="card">
@@ -282,248 +2988,404 @@ def home():
             <p><strong>Метод:</strong> WebSocket (disnake)</p>
             <p><strong>Python:</strong> 3.10.13</p>
             <p><strong>Самопинг:</strong> Каждые 8 минут</p>
-            <p><strong>Защита от дублей:</strong> Да (кеш 50 сообщений)</p>
+            <p><strong>Защита от дублей:</strong> Да (кеш {dedup_size} сообщений на канал)</p>
             <p><strong>Уведомления:</strong> Стикеры в канал + полные логи в бота + новости</p>
         </div>
         
         <div class="card">
             <h2>🔍 Тестирование</h2>
-            <p><a href="/health">Статус здоровья</a> | <a href="/test">Тест бота</a></p>
+            <p><a href="/health">Статус здоровья</a> | <a href="/healthz">Пинг</a> | <a href="/metrics">Метрики</a> | <a href="/stats">Статистика</a> | <a href="/history">История</a> | <a href="/test">Тест бота</a></p>
         </div>
+        <script>
+            // Аптайм считает браузер, чтобы страница не менялась каждую секунду
+            var el = document.getElementById('uptime');
+            var s = Math.floor(Date.now() / 1000 - el.dataset.start);
+            el.textContent = Math.floor(s / 3600) + ':' + String(Math.floor(s / 60) % 60).padStart(2, '0')
+                + ':' + String(s % 60).padStart(2, '0');
+        </script>
     </body>
     </html>
     """
 
-@app.route('/health')
-def health():
+
+class CachedPage:
+    """Готовая страница в памяти: перерисовывается только при смене ключа состояния"""
+
+    def __init__(self, render, mimetype='text/html; charset=utf-8'):
+        self._render = render
+        self.mimetype = mimetype
+        self._lock = threading.Lock()
+        self._key = object()
+        self._state = None
+        self.renders = 0
+
+    def get(self, key):
+        if key != self._key:
+            with self._lock:
+                if key != self._key:
+                    body = self._render().encode('utf-8')
+                    # Тела и ETag'и публикуются одним кортежем: читатель без блокировки не увидит смесь.
+                    # У сжатого варианта свой ETag — это другое представление (Vary: Accept-Encoding)
+                    etag = '%x' % zlib.crc32(body)
+                    self._state = (body, gzip.compress(body, 6), f'"{etag}"', f'"{etag}-gzip"')
+                    self._key = key
+                    self.renders += 1
+        return self._state
+
+    def response(self, flask, key):
+        """Отдаёт страницу с учётом If-None-Match и Accept-Encoding"""
+        request = flask.request
+        body, gzipped, etag, gzip_etag = self.get(key)
+        # Качество с учётом q-параметров: "gzip;q=0" — это отказ от gzip
+        use_gzip = request.accept_encodings['gzip'] > 0
+        if use_gzip:
+            body, etag = gzipped, gzip_etag
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+        if etag in request.headers.get('If-None-Match', ''):
+            return flask.Response(status=304, headers=headers)
+        if use_gzip:
+            headers['Content-Encoding'] = 'gzip'
+        return flask.Response(body, mimetype=self.mimetype, headers=headers)
+
+
+def render_dashboard():
+    items = routes.all_items()
+    current = state.snapshot()
+    stats = [f"<li>{html.escape(stat)}</li>" for stat in current.found_stats(items)]
+    
+    tracked = "".join(
+        f"<li>{html.escape(item['emoji'])} {html.escape(item['display_name'])}"
+        f"{' (только точное совпадение)' if item.get('match') == 'exact' else ''}</li>"
+        for item in items.values()
+    )
+    
+    forecasts = []
+    for channel_id, predictor in list(predictors.items()):
+        summary = predictor.summary()
+        if not summary['next_at']:
+            continue
+        route = routes.get(int(channel_id))
+        route_items = predictor.source.current.items
+        chances = ", ".join(
+            f"{html.escape(route_items[name]['emoji'])} {probability:.0%}"
+            for name, probability in summary['probabilities'].items() if name in route_items
+        )
+        accuracy = summary['accuracy']
+        error = f"±{accuracy['mean_abs_error_seconds']} сек" if accuracy['samples'] else "пока нет данных"
+        forecasts.append(
+            f"<p><strong>{html.escape(route.name if route else channel_id)}:</strong> следующий сток ~{summary['next_at'][11:]} "
+            f"(период {summary['period_seconds']} сек)<br>🎲 {chances}<br>"
+            f"🎯 Точность: {error}, Brier {accuracy['brier_score'] if accuracy['brier_score'] is not None else '—'}"
+            f" ({accuracy['samples']} прогнозов)</p>"
+        )
+    
+    return DASHBOARD_TEMPLATE.format(
+        start_epoch=int(bot_start_time.timestamp()),
+        start_str=bot_start_time.strftime('%d.%m %H:%M:%S'),
+        ping_count=current.ping_count,
+        processed=current.processed,
+        channels="".join(f"<li>{html.escape(route.label())}</li>" for route in routes)
+                 or '<li>Маршруты не настроены</li>',
+        tracked=tracked,
+        forecasts="".join(forecasts) if forecasts else '<p>Недостаточно истории для прогноза</p>',
+        stats="".join(stats) if stats else '<li>Пока ничего не найдено</li>',
+        dedup_size=DEDUP_CACHE_SIZE,
+    )
+
+
+dashboard = CachedPage(render_dashboard)
+
+
+def dashboard_key():
+    """Всё, от чего зависит страница; сравнение кортежа стоит микросекунды"""
+    return (
+        tuple(route_catalogue.current.version for route_catalogue in list(routes.catalogues.values())),
+        len(routes),
+        state.version,
+        tuple((len(p.times), p.next_at, p._brier_count) for p in list(predictors.values())),
+    )
+
+
+# Вьюхи получают модуль flask первым аргументом: его импортирует run_flask и передаёт в create_app
+def home(flask):
+    return dashboard.response(flask, dashboard_key())
+
+def healthz(flask):
+    """Лёгкая проверка для самопинга и мониторов: без дат и JSON"""
+    return HEALTHZ_BODY, 200, HEALTHZ_HEADERS
+
+HEALTHZ_BODY = b'ok\n'
+HEALTHZ_HEADERS = {'Content-Type': 'text/plain', 'Cache-Control': 'no-store'}
+
+def health(flask):
+    current = state.snapshot()
     return {
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
         'uptime_seconds': (datetime.now() - bot_start_time).total_seconds(),
-        'ping_count': ping_count,
-        'found_items': found_items_count,
-        'processed_messages': len(processed_messages),
+        'ping_count': current.ping_count,
+        'last_ping_time': current.last_ping_time.isoformat() if current.last_ping_time else None,
+        'found_items': current.found,
+        'processed_messages': current.processed,
+        'dedup_cache_size': len(processed_messages),
+        'fallback_poller': poller.stats(),
+        'gateway': watchdog.stats(),
+        'scheduler': scheduler.stats(),
+        'rates': rollup.summary(),
+        'prefilter_rejected': {reason: count for (reason,), count in MESSAGES_REJECTED.snapshot().items()},
+        'telegram_queue': outbox.stats(),
+        'predictions': {channel_id: predictor.summary() for channel_id, predictor in list(predictors.items())},
         'python_version': '3.10.13',
         'service_url': RENDER_SERVICE_URL,
-        'channels': {
-            'stocks': STOCKS_CHANNEL_ID,
-            'news': NEWS_CHANNEL_ID
-        }
+        'routes': [route.describe() for route in routes],
+        'startup': startup.report(),
     }
 
-@app.route('/test')
-def test():
+def metrics_endpoint(flask):
+    return flask.Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def _since_param(request):
+    """since: unix-время или ?days=N"""
+    if request.args.get('since'):
+        return float(request.args['since'])
+    if request.args.get('days'):
+        return time.time() - float(request.args['days']) * 86400
+    return None
+
+def history_endpoint(flask):
+    request = flask.request
+    if not history.enabled:
+        return {'error': 'история отключена'}, 503
+    try:
+        limit = max(1, min(int(request.args.get('limit', 50)), 1000))
+        rows = history.history(request.args.get('item'), _since_param(request), limit)
+    except ValueError:
+        return {'error': 'неверные параметры'}, 400
+    for row in rows:
+        row['time'] = datetime.fromtimestamp(row['ts']).isoformat(timespec='seconds')
+    return {'count': len(rows), 'items': rows}
+
+def stats_endpoint(flask):
+    request = flask.request
+    if not history.enabled:
+        return {'error': 'история отключена'}, 503
+    try:
+        rows = history.stats(request.args.get('item'), _since_param(request),
+                             targets_only=request.args.get('all') != '1')
+    except ValueError:
+        return {'error': 'неверные параметры'}, 400
+    for row in rows:
+        row['last_seen_time'] = datetime.fromtimestamp(row['last_seen']).isoformat(timespec='seconds')
+        row['first_seen_time'] = datetime.fromtimestamp(row['first_seen']).isoformat(timespec='seconds')
+    return {'stocks_written': history.written, 'items': rows}
+
+def test(flask):
     send_to_bot("🧪 <b>Тест от бота!</b>\nЕсли видишь это - бот работает!")
     return "✅ Тестовое сообщение отправлено в бота"
 
+URL_RULES = (
+    ('/', home),
+    ('/healthz', healthz),
+    ('/health', health),
+    ('/metrics', metrics_endpoint),
+    ('/history', history_endpoint),
+    ('/stats', stats_endpoint),
+    ('/test', test),
+)
+
+def create_app(flask):
+    """Приложение Flask из уже импортированного модуля flask — импорт откладывается до запуска веб-сервера"""
+    app = flask.Flask(__name__)
+    for rule, view in URL_RULES:
+        app.add_url_rule(rule, view.__name__, functools.partial(view, flask))
+    return app
+
 # ==================== ЗАПУСК FLASK ====================
 def run_flask():
-    from waitress import serve
+    app = create_app(_timed_import('flask'))
+    waitress = _timed_import('waitress')
     port = int(os.getenv('PORT', 10000))
+    # create_server уже слушает порт — отмечаем фазу по факту, а не перед запуском
+    server = waitress.create_server(app, host='0.0.0.0', port=port)
+    startup.mark('web_listening')
     logger.info(f'🌐 Веб-сервер запущен на порту {port}')
-    serve(app, host='0.0.0.0', port=port)
+    server.run()
+
+# ==================== DISCORD КЛИЕНТ ====================
+def create_client():
+    """Клиент Discord с обработчиками событий; создаётся внутри работающего цикла"""
+    # Только серверы и сообщения в их каналах: без участников, присутствия, реакций и ЛС
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.guild_messages = True
+    intents.message_content = True
+    
+    client = discord.Client(
+        intents=intents,
+        max_messages=None,                  # кеш сообщений не нужен
+        chunk_guilds_at_startup=False,
+        member_cache_flags=discord.MemberCacheFlags.none(),
+    )
+    announced = False
+    
+    @client.event
+    async def on_ready():
+        nonlocal announced
+        logger.info(f'✅ Discord бот {client.user} подключен!')
+        startup.mark('gateway_ready')
+        outbox.start()
+        # Догоняем то, что пришло, пока бот был офлайн или шлюз переподключался
+        poller.gateway_restored(client.user)
+        
+        if announced:
+            send_to_bot("✅ <b>Клиент Discord снова на связи</b>")
+            return
+        announced = True
+        
+        # Серверы вне таблицы маршрутов только шумят в шлюзе — их лучше покинуть
+        wanted = routes.guild_ids()
+        extra = [guild.name for guild in client.guilds if wanted and guild.id not in wanted]
+        if extra:
+            logger.warning(f"⚠️ Бот состоит в серверах без маршрутов: {', '.join(extra)}")
+        missing = [route.name for route in routes if client.get_channel(route.channel_id) is None]
+        if missing:
+            logger.warning(f"⚠️ Каналы маршрутов не видны боту: {', '.join(missing)}")
+        
+        items_list = "\n".join([
+            f"{config['emoji']} {config['display_name']}" 
+            for config in routes.all_items().values()
+        ])
+        
+        msg = (
+            f"✅ <b>Мониторинг новой игры запущен!</b>\n\n"
+            f"🎯 <b>Отслеживаю:</b>\n{items_list}\n\n"
+            + "".join(f"{html.escape(route.label())}\n" for route in routes)
+        )
+        msg += f"⏰ Запущен: {bot_start_time.strftime('%H:%M:%S')}\n\n✅ Бот готов!"
+        
+        send_to_bot(msg)
+    
+    @client.event
+    async def on_message(message):
+        await handle_message(message, client.user)
+    
+    @client.event
+    async def on_raw_message_edit(payload):
+        # Кеш сообщений выключен, поэтому on_message_edit не придёт — работаем с сырым событием
+        await handle_message_edit(payload.data, client.user)
+    
+    @client.event
+    async def on_disconnect():
+        logger.warning("⚠️ Discord WebSocket отключен")
+        send_to_bot("⚠️ <b>Discord WebSocket отключен</b>\nАвтопереподключение, стоки читаются через REST...")
+        poller.gateway_lost()
+    
+    @client.event 
+    async def on_resumed():
+        logger.info("✅ Discord WebSocket восстановлен")
+        send_to_bot("✅ <b>Discord WebSocket восстановлен</b>")
+        poller.gateway_restored()
+    
+    return client
+
+
+async def start_auxiliary():
+    """Всё, без чего можно принять первый сток, поднимается параллельно с подключением к шлюзу"""
+    loop = asyncio.get_running_loop()
+    
+    # Веб-сервер: Render ждёт открытый порт, но шлюзу он не нужен
+    threading.Thread(target=run_flask, daemon=True).start()
+    
+    # Планировщик первым: самопинг, watchdog и снапшоты не должны зависеть от истории
+    schedule_jobs()
+    scheduler.start()
+    
+    # История стоков пишется в фоновом потоке, по ней же строится прогноз
+    try:
+        await loop.run_in_executor(None, history.start)
+    except (sqlite3.Error, OSError) as e:
+        logger.error(f"❌ История стоков недоступна ({history.path}): {e}")
+        send_to_bot(f"⚠️ <b>История стоков отключена</b>\n<code>{html.escape(str(e))[:200]}</code>")
+    seed_predictors(routes.stock_routes())
+    startup.mark('history_ready')
+    startup.mark('auxiliary_ready')
+
+
+def _auxiliary_done(task):
+    """Падение фоновой подготовки не должно пройти молча"""
+    if task.cancelled() or task.exception() is None:
+        return
+    error = task.exception()
+    logger.error(f"💥 Ошибка запуска фоновых задач: {error!r}")
+    send_to_bot(f"💥 <b>Ошибка запуска фоновых задач:</b>\n<code>{html.escape(repr(error))[:200]}</code>")
+
+
+async def run_bot():
+    """Цикл бота: планировщик, очередь Telegram и клиент Discord, который watchdog может перезапустить"""
+    client = create_client()
+    outbox.bind(asyncio.get_running_loop())
+    watchdog.client = client
+    # Задача стартует на следующем шаге цикла — к этому моменту client.start() уже отправил логин
+    auxiliary = asyncio.get_running_loop().create_task(start_auxiliary())
+    auxiliary.add_done_callback(_auxiliary_done)
+    startup.mark('gateway_connecting')
+    try:
+        while True:
+            logger.info('🔗 Подключение к Discord...')
+            try:
+                await client.start(DISCORD_TOKEN)
+            except Exception as e:
+                if not watchdog.restart_requested:
+                    raise
+                logger.warning(f"⚠️ Клиент Discord завершился при перезапуске: {e!r}")
+            if not watchdog.restart_requested:
+                break
+            # Тот же объект клиента, чистое состояние: обработчики событий сохраняются
+            watchdog.restart_requested = False
+            client.clear()
+    finally:
+        auxiliary.cancel()
+        scheduler.stop()
+        if not client.is_closed():
+            await client.close()
+        outbox.save()
+        processed_messages.save()
+        await poller.close()
+        await telegram.close()
 
 # ==================== ЗАПУСК ВСЕГО ====================
 if __name__ == '__main__':
+    startup.mark('imports')
+    check_config()
+    startup.mark('config')
+    
     print('=' * 60)
     print('🚀 ЗАПУСК МОНИТОРИНГА НОВОЙ ИГРЫ')
     print('=' * 60)
-    print(f'📦 Канал стоков: {STOCKS_CHANNEL_ID}')
-    if NEWS_CHANNEL_ID:
-        print(f'📰 Канал новостей: {NEWS_CHANNEL_ID}')
+    for route in routes:
+        print(route.label())
     print('🎯 Отслеживаю:')
-    print('   🍒 Cherry')
-    print('   🥬 Cabbage')
-    print('   💧 Super Sprinkler (только точное совпадение)')
-    print('📨 В канал стоков: стикер')
+    for item in routes.all_items().values():
+        exact = ' (только точное совпадение)' if item.get('match') == 'exact' else ''
+        print(f"   {item['emoji']} {item['display_name']}{exact}")
+    print('📨 В каналы стоков: стикер')
     print('🤖 В бота: полный сток + уведомления')
-    if NEWS_CHANNEL_ID:
-        print('📰 Новости: пересылка в отдельный канал')
     print('🛡️ Защита от дублей: Да')
     print('🏓 Самопинг: каждые 8 минут')
     print('=' * 60)
     
-    # Запускаем Flask
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-    
-    time.sleep(3)
-    
-    # Запускаем самопинг
-    ping_thread = threading.Thread(target=self_pinger, daemon=True)
-    ping_thread.start()
+    # Кеш дублей и очередь нужны до первого сообщения; остальное поднимет start_auxiliary()
+    outbox.load()
+    processed_messages.load()
+    startup.mark('state_loaded')
     
     # ==================== DISCORD БОТ ====================
     try:
-        intents = discord.Intents.default()
-        intents.message_content = True
-        intents.guilds = True
-        
-        client = discord.Client(intents=intents)
-        
-        @client.event
-        async def on_ready():
-            logger.info(f'✅ Discord бот {client.user} подключен!')
-            
-            items_list = "\n".join([
-                f"{config['emoji']} {config['display_name']}" 
-                for config in TARGET_ITEMS.values()
-            ])
-            
-            msg = (
-                f"✅ <b>Мониторинг новой игры запущен!</b>\n\n"
-                f"🎯 <b>Отслеживаю:</b>\n{items_list}\n\n"
-                f"📦 Канал стоков: {STOCKS_CHANNEL_ID}\n"
-            )
-            if NEWS_CHANNEL_ID:
-                msg += f"📰 Канал новостей: {NEWS_CHANNEL_ID}\n"
-            msg += f"⏰ Запущен: {bot_start_time.strftime('%H:%M:%S')}\n\n✅ Бот готов!"
-            
-            send_to_bot(msg)
-        
-        @client.event
-        async def on_message(message):
-            try:
-                global processed_messages
-                
-                if message.author == client.user:
-                    return
-                
-                channel_id = str(message.channel.id)
-                
-                # ===== НОВОСТНОЙ КАНАЛ =====
-                if NEWS_CHANNEL_ID and channel_id == NEWS_CHANNEL_ID:
-                    # Защита от дублей
-                    if message.id in processed_messages:
-                        return
-                    
-                    processed_messages.add(message.id)
-                    if len(processed_messages) > MAX_CACHE_SIZE:
-                        processed_messages.remove(next(iter(processed_messages)))
-                    
-                    logger.info(f"📰 Новость в канале {channel_id}")
-                    
-                    # Отправляем текст в Telegram
-                    if NEWS_TELEGRAM_CHANNEL:
-                        news_text = message.content if message.content else "📄 Новость без текста"
-                        
-                        # Добавляем информацию об авторе и времени
-                        current_time = datetime.now().strftime('%H:%M:%S')
-                        full_news = (
-                            f"📰 <b>Новость в {current_time}</b>\n"
-                            f"👤 <i>{message.author.name}</i>\n\n"
-                            f"{news_text}"
-                        )
-                        
-                        send_telegram(NEWS_TELEGRAM_CHANNEL, full_news)
-                        logger.info("✅ Новость отправлена в Telegram")
-                    
-                    return  # Не обрабатываем как сток
-                
-                # ===== КАНАЛ СО СТОКАМИ =====
-                if channel_id != STOCKS_CHANNEL_ID:
-                    return
-                
-                # Проверяем автора (ищем Kiro или другого бота)
-                if 'kiro' not in message.author.name.lower():
-                    return
-                
-                # Защита от дублей
-                if message.id in processed_messages:
-                    logger.info(f"⏭️ Пропускаем дубль {message.id}")
-                    return
-                
-                processed_messages.add(message.id)
-                if len(processed_messages) > MAX_CACHE_SIZE:
-                    processed_messages.remove(next(iter(processed_messages)))
-                
-                logger.info(f"📨 Сообщение от Kiro (ID: {message.id})")
-                
-                full_content = extract_full_content(message)
-                if not full_content:
-                    logger.info("📭 Сообщение пустое")
-                    return
-                
-                logger.info(f"📋 Полный сток ({len(full_content)} символов)")
-                
-                # Ищем предметы
-                found_items = []
-                lower_content = full_content.lower()
-                
-                for item_name, item_config in TARGET_ITEMS.items():
-                    for keyword in item_config['keywords']:
-                        if keyword.lower() in lower_content:
-                            found_items.append(item_name)
-                            logger.info(f"🎯 Найдено: {keyword} → {item_config['display_name']}")
-                            break
-                
-                current_time = datetime.now().strftime('%H:%M:%S')
-                
-                if found_items:
-                    for item_name in found_items:
-                        item_config = TARGET_ITEMS[item_name]
-                        found_items_count[item_name] += 1
-                        
-                        # Стикер в канал
-                        if item_config['sticker_id']:
-                            send_telegram_sticker(STOCKS_TELEGRAM_CHANNEL, item_config['sticker_id'])
-                        
-                        logger.info(f"✅ {item_config['emoji']} {item_config['display_name']} в {current_time}")
-                    
-                    # Полный сток в бота
-                    found_items_list = "\n".join([f"• {TARGET_ITEMS[name]['emoji']} {TARGET_ITEMS[name]['display_name']}" for name in found_items])
-                    
-                    formatted_stock = full_content
-                    if len(formatted_stock) > 3000:
-                        formatted_stock = formatted_stock[:3000] + "\n... (сообщение обрезано)"
-                    
-                    bot_message = (
-                        f"🎯 <b>Обнаружены предметы в {current_time}:</b>\n"
-                        f"{found_items_list}\n\n"
-                        f"📋 <b>Полный сток:</b>\n"
-                        f"<pre>{formatted_stock}</pre>\n\n"
-                        f"#сток"
-                    )
-                    
-                    send_to_bot(bot_message)
-                    logger.info(f"📨 Полный сток отправлен в бота ({len(found_items)} предметов)")
-                    
-                else:
-                    logger.info("📭 Целевые предметы не найдены")
-                    
-                    formatted_stock = full_content
-                    if len(formatted_stock) > 3000:
-                        formatted_stock = formatted_stock[:3000] + "\n... (сообщение обрезано)"
-                    
-                    bot_message = (
-                        f"📊 <b>Сток от Kiro в {current_time}</b>\n"
-                        f"🎯 Целевые предметы: не найдены\n\n"
-                        f"📋 <b>Полный сток:</b>\n"
-                        f"<pre>{formatted_stock}</pre>"
-                    )
-                    send_to_bot(bot_message)
-                    logger.info("📨 Пустой сток отправлен в бота")
-                    
-            except Exception as e:
-                logger.error(f"💥 Ошибка обработки сообщения: {e}")
-                error_msg = f"⚠️ <b>Ошибка обработки сообщения:</b>\n<code>{str(e)[:200]}</code>"
-                send_to_bot(error_msg)
-        
-        @client.event
-        async def on_disconnect():
-            logger.warning("⚠️ Discord WebSocket отключен")
-            send_to_bot("⚠️ <b>Discord WebSocket отключен</b>\nАвтопереподключение...")
-        
-        @client.event 
-        async def on_resumed():
-            logger.info("✅ Discord WebSocket восстановлен")
-            send_to_bot("✅ <b>Discord WebSocket восстановлен</b>")
-        
-        logger.info('🔗 Подключение к Discord...')
-        client.run(DISCORD_TOKEN)
-        
+        asyncio.run(run_bot())
     except KeyboardInterrupt:
         logger.info("🛑 Остановка бота")
     except Exception as e:
         logger.error(f"💥 Критическая ошибка: {e}")
         send_to_bot(f"🚨 <b>Критическая ошибка Discord:</b>\n<code>{str(e)[:200]}</code>")
+    finally:
+        history.close()
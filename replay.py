@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+"""
+🧪 СТЕНД REPLAY: прогоняет записанные сообщения Kiro через конвейер бота
+против локального фейкового Telegram API и меряет задержки.
+
+    python replay.py samples/kiro_corpus.json --rate 20 --repeat 50
+    python replay.py samples/kiro_corpus.json --poll --page-size 2   # через резервный REST-опрос
+    python replay.py samples/kiro_corpus.json --rate-limit-every 2 --expect samples/kiro_corpus.expected.json
+
+С --expect алерты на первый прогон корпуса сверяются с ожидаемыми (файл описывает прогон
+через шлюз), а в каждом чате проверяется, что Telegram получил отправки в порядке постановки,
+в том числе после ответов 429. При расхождении код выхода — 1. --save-expected перезаписывает
+файл ожиданий текущим результатом.
+
+Формат корпуса — JSON-список сообщений:
+    {"channel": "stocks" | "news" | "<id>", "author": "Kiro",
+     "content": "...", "embeds": [<embed в формате Discord API>]}
+Правка сообщения #N корпуса (MESSAGE_UPDATE; канал и автор — как у оригинала):
+    {"edit_of": N, "content": "...", "embeds": [...]}
+"""
+
+import argparse
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import re
+import sys
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+STOCKS_CHANNEL_ID = '100000000000000001'
+NEWS_CHANNEL_ID = '100000000000000002'
+STOCKS_TELEGRAM_CHANNEL = '-1000000000001'
+NEWS_TELEGRAM_CHANNEL = '-1000000000002'
+BOT_CHAT_ID = '1000000001'
+DISCORD_EPOCH = 1420070400000
+FIRST_MESSAGE_ID = (int(time.time() * 1000) - DISCORD_EPOCH) << 22   # снежинки «сейчас», чтобы опрос не счёл их старыми
+
+current_message = contextvars.ContextVar('current_message', default=None)
+
+
+# ==================== ФЕЙКОВЫЙ TELEGRAM ====================
+class FakeTelegram:
+    """Локальный сервер с ответами как у Bot API: записывает все запросы"""
+
+    def __init__(self, latency=0.0, rate_limit_every=0):
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.requests = []
+        self._count = 0
+        self._runner = None
+
+    async def handle(self, request):
+        from aiohttp import web
+
+        self._count += 1
+        payload = await request.json()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.rate_limit_every and self._count % self.rate_limit_every == 0:
+            return web.json_response(
+                {'ok': False, 'error_code': 429, 'parameters': {'retry_after': 1}}, status=429)
+        self.requests.append((time.monotonic(), request.match_info['method'], payload))
+        return web.json_response({'ok': True, 'result': {'message_id': self._count}})
+
+    async def start(self, port):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+# ==================== ФЕЙКОВЫЙ DISCORD REST ====================
+class FakeDiscord:
+    """Локальный GET /channels/{id}/messages с курсором after и заголовками лимитов как у Discord"""
+
+    def __init__(self, bucket=5, reset_after=0.2):
+        self.bucket = bucket
+        self.reset_after = reset_after
+        self.channels = {}
+        self.requests = []
+        self.rate_limited = 0
+        self._remaining = bucket
+        self._reset_at = 0.0
+        self._runner = None
+
+    def add(self, channel_id, payload):
+        self.channels.setdefault(str(channel_id), []).append(payload)
+
+    async def handle(self, request):
+        from aiohttp import web
+
+        now = time.monotonic()
+        if now >= self._reset_at:
+            self._remaining, self._reset_at = self.bucket, now + self.reset_after
+        if self._remaining == 0:
+            self.rate_limited += 1
+            return web.json_response(
+                {'message': 'You are being rate limited.', 'retry_after': self._reset_at - now, 'global': False},
+                status=429)
+        self._remaining -= 1
+
+        after = int(request.query.get('after', 0))
+        limit = min(100, int(request.query.get('limit', 50)))
+        newer = sorted((m for m in self.channels.get(request.match_info['channel'], ())
+                        if int(m['id']) > after), key=lambda m: int(m['id']))[:limit]
+        self.requests.append((request.match_info['channel'], after, len(newer)))
+        headers = {'X-RateLimit-Limit': str(self.bucket), 'X-RateLimit-Remaining': str(self._remaining),
+                   'X-RateLimit-Reset-After': f"{max(0.0, self._reset_at - now):.3f}"}
+        # Как и Discord, отдаём страницу от новых к старым
+        return web.json_response(newer[::-1], headers=headers)
+
+    async def start(self, port):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get('/api/v10/channels/{channel}/messages', self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+# ==================== СООБЩЕНИЯ ====================
+def configure_env(args):
+    """Настраивает бота на фейковые каналы и сервер до его импорта"""
+    os.environ.update({
+        'DISCORD_TOKEN': 'replay',
+        'TELEGRAM_TOKEN': 'replay',
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{args.port}',
+        'TELEGRAM_BOT_CHAT_ID': BOT_CHAT_ID,
+        'STOCKS_CHANNEL_ID': STOCKS_CHANNEL_ID,
+        'STOCKS_TELEGRAM_CHANNEL': STOCKS_TELEGRAM_CHANNEL,
+        'NEWS_CHANNEL_ID': NEWS_CHANNEL_ID,
+        'NEWS_TELEGRAM_CHANNEL': NEWS_TELEGRAM_CHANNEL,
+        'TELEGRAM_QUEUE_FILE': '',
+        'DEDUP_CACHE_FILE': '',
+        'ROUTES_FILE': args.routes or '',
+        'DISCORD_API_URL': f'http://127.0.0.1:{args.port + 1}/api/v10',
+    })
+    if args.chat_rate:
+        os.environ['TELEGRAM_CHAT_RATE'] = str(args.chat_rate)
+        os.environ['TELEGRAM_CHAT_BURST'] = str(max(1, int(args.chat_rate)))
+    if args.items:
+        os.environ['ITEMS_FILE'] = args.items
+    if args.author_ids:
+        os.environ['STOCKS_AUTHOR_IDS'] = args.author_ids
+
+
+def build_message(entry, message_id):
+    """Собирает объект с интерфейсом disnake.Message из записи корпуса"""
+    import disnake
+
+    channel = channel_of(entry)
+    author_name = entry.get('author', 'Kiro')
+    return SimpleNamespace(
+        id=message_id,
+        channel=SimpleNamespace(id=int(channel)),
+        guild=SimpleNamespace(id=int(entry.get('guild', 0))),
+        author=SimpleNamespace(id=int(entry.get('author_id', 0)), name=author_name, bot=entry.get('bot', True)),
+        webhook_id=entry.get('webhook_id'),
+        application_id=entry.get('application_id'),
+        content=entry.get('content', ''),
+        embeds=[disnake.Embed.from_dict(embed) for embed in entry.get('embeds', [])],
+        created_at=datetime.now(timezone.utc),
+    )
+
+
+def build_payload(entry, message_id):
+    """Та же запись корпуса в виде JSON сообщения REST API"""
+    payload = {
+        'id': str(message_id),
+        'author': {'id': str(entry.get('author_id', 0)), 'username': entry.get('author', 'Kiro'),
+                   'bot': entry.get('bot', True)},
+        'content': entry.get('content', ''),
+        'embeds': entry.get('embeds', []),
+    }
+    for key in ('webhook_id', 'application_id'):
+        if entry.get(key):
+            payload[key] = str(entry[key])
+    return payload
+
+
+def channel_of(entry):
+    return {'stocks': STOCKS_CHANNEL_ID, 'news': NEWS_CHANNEL_ID}.get(entry.get('channel'), entry.get('channel'))
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def fmt_ms(seconds):
+    return '—' if seconds is None else f"{seconds * 1000:.1f} мс"
+
+
+# ==================== ПРОГОН ====================
+async def replay(args, corpus):
+    fake = FakeTelegram(latency=args.latency / 1000, rate_limit_every=args.rate_limit_every)
+    await fake.start(args.port)
+
+    import bot
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    bot.catalogue.load()
+    bot.routes.load()
+    bot.outbox.bind(asyncio.get_running_loop())
+
+    # Каждая отправка в Telegram помечается индексом сообщения, которое её вызвало
+    deliveries = []
+    original_put_many = bot.outbox.put_many
+
+    def traced_put_many(chat_id, requests):
+        futures = original_put_many(chat_id, requests)
+        for (method, payload), future in zip(requests, futures):
+            record = {'message': current_message.get(), 'method': method, 'chat': str(chat_id),
+                      'payload': payload, 'done_at': None}
+            if isinstance(future, asyncio.Future):
+                future.add_done_callback(lambda _, record=record: record.__setitem__('done_at', time.monotonic()))
+            deliveries.append(record)
+        return futures
+
+    bot.outbox.put_many = traced_put_many
+
+    total = len(corpus) * args.repeat
+    interval = 1 / args.rate if args.rate else 0
+    dispatched_at = {}
+    handler_times = []
+
+    async def run_one(index, message, handle=None):
+        current_message.set(index)
+        started = time.monotonic()
+        dispatched_at[index] = started
+        await (handle or bot.handle_message)(message)
+        handler_times.append(time.monotonic() - started)
+
+    def edit_payload(index, entry):
+        """MESSAGE_UPDATE для сообщения того же прогона корпуса"""
+        base = index - index % len(corpus)
+        original = corpus[entry['edit_of']]
+        data = build_payload({**original, **entry}, FIRST_MESSAGE_ID + base + entry['edit_of'])
+        data['channel_id'] = channel_of(original)
+        return data
+
+    fake_discord = None
+    replay_started = time.monotonic()
+    if args.poll:
+        # Шлюз «лежит»: весь корпус лежит в фейковом REST, бот догоняет его резервным опросом
+        fake_discord = FakeDiscord()
+        for index in range(total):
+            entry = corpus[index % len(corpus)]
+            if 'edit_of' not in entry:  # правки опрос не видит — только исходные сообщения
+                fake_discord.add(channel_of(entry), build_payload(entry, FIRST_MESSAGE_ID + index))
+        await fake_discord.start(args.port + 1)
+        for route in bot.routes:
+            bot.poller.cursors[route.channel_id] = FIRST_MESSAGE_ID - 1
+        bot.poller.page_size = args.page_size
+
+        original_handle = bot.handle_message
+
+        async def traced_handle(message, bot_user=None):
+            await run_one(message.id - FIRST_MESSAGE_ID, message, original_handle)
+
+        bot.handle_message = traced_handle
+        replay_started = time.monotonic()
+        await bot.poller.catch_up()
+        await bot.poller.close()
+    else:
+        tasks = []
+        for index in range(total):
+            entry = corpus[index % len(corpus)]
+            if 'edit_of' in entry:
+                tasks.append(asyncio.create_task(run_one(index, edit_payload(index, entry), bot.handle_message_edit)))
+            else:
+                message = build_message(entry, FIRST_MESSAGE_ID + index)
+                tasks.append(asyncio.create_task(run_one(index, message)))
+            if interval:
+                await asyncio.sleep(max(0.0, replay_started + (index + 1) * interval - time.monotonic()))
+            else:
+                await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+    dispatch_duration = time.monotonic() - replay_started
+
+    pending = [record for record in deliveries if record['done_at'] is None]
+    deadline = time.monotonic() + args.timeout
+    while pending and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+        pending = [record for record in deliveries if record['done_at'] is None]
+    total_duration = time.monotonic() - replay_started
+
+    await bot.telegram.close()
+    await fake.stop()
+    if fake_discord is not None:
+        await fake_discord.stop()
+        print(f"🛟 Запросов к фейковому REST Discord: {len(fake_discord.requests)} "
+              f"(429: {fake_discord.rate_limited})")
+    return bot, fake, deliveries, dispatched_at, handler_times, dispatch_duration, total_duration
+
+
+def alert_key(bot, record):
+    """Устойчивое описание алерта для файла ожиданий: без времени и ID стикеров"""
+    payload = record['payload']
+    if record['method'] == 'sendSticker':
+        for item_name, item in bot.catalogue.current.items.items():
+            if item.get('sticker_id') == payload.get('sticker'):
+                return f"sticker {item_name} → {record['chat']}"
+        return f"sticker ? → {record['chat']}"
+    first_line = re.sub(r'\d\d:\d\d:\d\d', 'HH:MM:SS', str(payload.get('text', '')).split('\n', 1)[0])
+    return f"{record['method']} → {record['chat']}: {first_line}"
+
+
+def corpus_alerts(bot, corpus, deliveries):
+    """Алерты первого прогона корпуса: список на каждое сообщение"""
+    alerts = [[] for _ in corpus]
+    for record in deliveries:
+        if record['message'] is not None and record['message'] < len(corpus):
+            alerts[record['message']].append(alert_key(bot, record))
+    return alerts
+
+
+def order_violations(fake, deliveries):
+    """Чаты, где Telegram получил отправки не в том порядке, в каком они встали в очередь"""
+    def key(method, payload):
+        return method, json.dumps(payload, sort_keys=True, ensure_ascii=False)
+
+    queued, received = {}, {}
+    for record in deliveries:
+        queued.setdefault(record['chat'], []).append(key(record['method'], record['payload']))
+    for _, method, payload in fake.requests:
+        received.setdefault(str(payload.get('chat_id')), []).append(key(method, payload))
+    return sorted(chat for chat, sent in received.items() if sent != queued.get(chat, [])[:len(sent)])
+
+
+def check(args, corpus, result):
+    """Сверяет прогон с файлом ожиданий; возвращает код выхода"""
+    bot, fake, deliveries = result[:3]
+    alerts = corpus_alerts(bot, corpus, deliveries)
+    if args.save_expected:
+        with open(args.save_expected, 'w', encoding='utf-8') as f:
+            json.dump(alerts, f, ensure_ascii=False, indent=2)
+            f.write('\n')
+        print(f"💾 Ожидаемые алерты сохранены в {args.save_expected}")
+
+    failures = []
+    if args.expect:
+        with open(args.expect, encoding='utf-8') as f:
+            expected = json.load(f)
+        if len(expected) != len(corpus):
+            failures.append(f"в файле ожиданий {len(expected)} сообщений, в корпусе {len(corpus)}")
+        for index, (want, got) in enumerate(zip(expected, alerts)):
+            if want != got:
+                failures.append(f"#{index}: ожидалось {want or 'нет'}, получено {got or 'нет'}")
+        undelivered = sum(1 for record in deliveries if record['done_at'] is None)
+        if undelivered:
+            failures.append(f"не доставлено за --timeout: {undelivered}")
+        for chat in order_violations(fake, deliveries):
+            failures.append(f"чат {chat}: порядок доставки отличается от порядка очереди")
+
+    if failures:
+        print('❌ Расхождения с ожиданиями:')
+        for failure in failures:
+            print(f"  {failure}")
+        return 1
+    if args.expect:
+        print(f"✅ Алерты совпадают с {args.expect}, порядок доставки сохранён")
+    return 0
+
+
+def describe_alert(bot, record):
+    payload = record['payload']
+    if record['method'] == 'sendSticker':
+        for item in bot.catalogue.current.items.values():
+            if item.get('sticker_id') == payload.get('sticker'):
+                return f"стикер {item['emoji']} {item['display_name']}"
+        return f"стикер {payload.get('sticker')}"
+    first_line = str(payload.get('text', '')).split('\n', 1)[0]
+    return f"{record['method']}: {first_line[:70]}"
+
+
+def report(args, corpus, result):
+    bot, fake, deliveries, dispatched_at, handler_times, dispatch_duration, total_duration = result
+    total = len(dispatched_at)
+    delivered = [record for record in deliveries if record['done_at'] is not None]
+    end_to_end = [record['done_at'] - dispatched_at[record['message']]
+                  for record in delivered if record['message'] is not None]
+
+    print('=' * 60)
+    print(f"📊 Сообщений: {total} за {dispatch_duration:.2f} сек "
+          f"({total / dispatch_duration if dispatch_duration else 0:.1f} msg/s)")
+    print(f"⏱️ Обработчик: p50 {fmt_ms(percentile(handler_times, 0.5))}, "
+          f"p99 {fmt_ms(percentile(handler_times, 0.99))}")
+    print(f"📨 Доставка в Telegram: {len(delivered)}/{len(deliveries)} за {total_duration:.2f} сек, "
+          f"p50 {fmt_ms(percentile(end_to_end, 0.5))}, p99 {fmt_ms(percentile(end_to_end, 0.99))}")
+    print(f"🌐 Запросов к фейковому API: {fake._count} (429: "
+          f"{fake._count - len(fake.requests)})")
+    rejected = {reason: count for (reason,), count in bot.MESSAGES_REJECTED.snapshot().items()}
+    print(f"🚫 Отсеяно префильтром: {sum(rejected.values())} "
+          f"({', '.join(f'{reason}: {count}' for reason, count in sorted(rejected.items())) or 'нет'})")
+    print('=' * 60)
+
+    # Алерты на первый прогон корпуса — ровно то, что ушло бы в Telegram
+    by_message = {}
+    for record in deliveries:
+        if record['message'] is not None and record['message'] < len(corpus):
+            by_message.setdefault(record['message'], []).append(record)
+    print('🎯 Алерты по корпусу:')
+    for index, entry in enumerate(corpus):
+        label = f"правка #{entry['edit_of']}" if 'edit_of' in entry else entry.get('channel', '?')
+        author = corpus[entry['edit_of']].get('author', 'Kiro') if 'edit_of' in entry else entry.get('author', 'Kiro')
+        alerts = by_message.get(index, [])
+        print(f"  #{index} [{label}] {author}: "
+              + (', '.join(f"{describe_alert(bot, record)} → {record['chat']}" for record in alerts) or 'нет'))
+
+    if args.json:
+        summary = {
+            'messages': total,
+            'throughput': total / dispatch_duration if dispatch_duration else None,
+            'handler_p50': percentile(handler_times, 0.5),
+            'handler_p99': percentile(handler_times, 0.99),
+            'delivery_p50': percentile(end_to_end, 0.5),
+            'delivery_p99': percentile(end_to_end, 0.99),
+            'alerts': [{'message': record['message'], 'method': record['method'], 'chat': record['chat'],
+                        'payload': record['payload']} for record in deliveries],
+        }
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"💾 Результаты сохранены в {args.json}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Прогон записанных сообщений через конвейер бота')
+    parser.add_argument('corpus', help='JSON-файл с записанными сообщениями')
+    parser.add_argument('--rate', type=float, default=0, help='сообщений в секунду (0 — без пауз)')
+    parser.add_argument('--repeat', type=int, default=1, help='сколько раз прогнать корпус')
+    parser.add_argument('--port', type=int, default=18080, help='порт фейкового Telegram API')
+    parser.add_argument('--latency', type=float, default=0, help='задержка ответа фейкового API, мс')
+    parser.add_argument('--rate-limit-every', type=int, default=0, help='отвечать 429 на каждый N-й запрос')
+    parser.add_argument('--chat-rate', type=float, default=0, help='лимит отправок в чат, msg/s (по умолчанию как в боте)')
+    parser.add_argument('--items', help='файл каталога предметов')
+    parser.add_argument('--author-ids', help='закрепить авторов стоков по ID (через запятую)')
+    parser.add_argument('--routes', help='таблица маршрутов (по умолчанию — каналы стенда)')
+    parser.add_argument('--poll', action='store_true', help='доставлять корпус через резервный REST-опрос, а не шлюз')
+    parser.add_argument('--page-size', type=int, default=100, help='размер страницы REST-опроса')
+    parser.add_argument('--timeout', type=float, default=30, help='сколько ждать доставки после прогона, сек')
+    parser.add_argument('--json', help='сохранить результаты в JSON')
+    parser.add_argument('--expect', help='файл ожидаемых алертов: при расхождении код выхода 1')
+    parser.add_argument('--save-expected', help='записать алерты прогона как ожидаемые')
+    parser.add_argument('--verbose', action='store_true', help='логи бота уровня INFO')
+    args = parser.parse_args()
+
+    with open(args.corpus, encoding='utf-8') as f:
+        corpus = json.load(f)
+
+    configure_env(args)
+    result = asyncio.run(replay(args, corpus))
+    report(args, corpus, result)
+    return check(args, corpus, result)
+
+
+if __name__ == '__main__':
+    sys.exit(main())